@@ -1,9 +1,64 @@
 from config import Config
+from game_store import SEQUENCES_KEY
+from query_cache import cached
+
+def opening_count(most_frequent):
+    """Format the top entry of the `openings` sorted set as most_frequent_opening's result.
+    """
+    if most_frequent:
+        return {
+            'opening': most_frequent[0][0],
+            'count': int(most_frequent[0][1])
+        }
+    return {'opening': None, 'count': 0}
+
+def queue_top_openings(pipe, limit):
+    """Queue the reads of the `limit` most played openings and every opening's result counts.
+    """
+    pipe.zrevrange('openings', 0, limit - 1, withscores=True)
+    for result in ('white', 'black', 'draw'):
+        pipe.zrange(f'openings:{result}', 0, -1, withscores=True)
+
+def top_opening_stats(results):
+    """Format the replies to `queue_top_openings` as top_openings' result.
+    """
+    openings, white, black, draw = [dict(replies) if i else replies for i, replies in enumerate(results)]
+    return [{
+        'opening': opening,
+        'count': int(count),
+        'white': int(white.get(opening, 0)),
+        'black': int(black.get(opening, 0)),
+        'draw': int(draw.get(opening, 0)),
+        'white_win_rate': white.get(opening, 0) / count
+    } for opening, count in openings]
+
+def ranked_sequences_stop(k):
+    """Validate the `k` of a ranked sequence query and return the last rank to read, or None
+    when there is nothing to read.
+    """
+    if k is not None and k < 0:
+        raise ValueError('k must not be negative')
+    return None if k == 0 else (k or 1) - 1
+
+def ranked_sequences(k, ranked):
+    """Format (sequence, count) pairs: without `k`, the first one (or an empty result); with
+    `k`, all of them.
+    """
+    sequences = [{
+        'sequence': sequence,
+        'count': int(count)
+    } for sequence, count in ranked]
+    if k is not None:
+        return sequences
+    return sequences[0] if sequences else {'sequence': None, 'count': 0}
 
 class AnalyticsFunctions:
-    def __init__(self):
+    def __init__(self, cache=None):
         self.r = Config.get_redis_connection()
+        # Optional QueryCache serving the global statistics between loads
+        self.cache = cache
 
+    @cached
     def shortest_game(self):
         return {
             'game_id': self.r.get(f'analytics:shortest_game'),
@@ -11,45 +66,40 @@ class AnalyticsFunctions:
         }
 
     def number_of_checks(self, game_id):
-        return int(self.r.get(f'game:{game_id}:analytics:check_count') or 0)
+        return int(self.r.hget(f'game:{game_id}', 'check_count') or 0)
 
+    @cached
     def most_frequent_opening(self):
-        opening = self.r.get('analytics:most_frequent_opening')
-        count = self.r.get(f'opening:{opening}')
-        
-        if opening and count:
-            return {
-                'opening': opening,
-                'count': int(count)
-            }
-        return {'opening': None, 'count': 0}
+        return opening_count(self.r.zrevrange('openings', 0, 0, withscores=True))
+
+    # Returns the most played openings with their result counts and the rate white wins at
+    @cached
+    def top_openings(self, limit=10):
+        pipe = self.r.pipeline(transaction=False)
+        queue_top_openings(pipe, limit)
+        return top_opening_stats(pipe.execute())
+
+    # Reads the sequences ranked from either end of the `sequences` sorted set. Without `k`,
+    # returns the first one (or an empty result); with `k`, a list of up to `k` of them (none for 0).
+    def _ranked_sequences(self, k, most_common):
+        stop = ranked_sequences_stop(k)
+        if stop is None:
+            return []
+        rank = self.r.zrevrange if most_common else self.r.zrange
+        return ranked_sequences(k, rank(SEQUENCES_KEY, 0, stop, withscores=True))
 
-    def most_common_three_move_sequence(self):
-        sequence = self.r.get('analytics:most_common_sequence')
-        count = self.r.get(f'sequence:{sequence}')
-        
-        if sequence and count:
-            return {
-                'sequence': sequence,
-                'count': int(count)
-            }
-        return {'sequence': None, 'count': 0}
+    @cached
+    def most_common_three_move_sequence(self, k=None):
+        return self._ranked_sequences(k, most_common=True)
     
-    def least_common_three_move_sequence(self):
-        sequence = self.r.get('analytics:least_common_sequence')
-        count = self.r.get(f'sequence:{sequence}')
-        
-        if sequence and count:
-            return {
-                'sequence': sequence,
-                'count': int(count)
-            }
-        return {'sequence': None, 'count': 0}
+    @cached
+    def least_common_three_move_sequence(self, k=None):
+        return self._ranked_sequences(k, most_common=False)
 
 if __name__ == "__main__":
     analytics_functions = AnalyticsFunctions()
    
-    choice = input("Choose an analytics function to run: \n 1. Shortest game \n 2. Number of checks \n 3. Most frequent opening \n 4. Most common three-move sequence \n 5. Least common three-move sequence \n")
+    choice = input("Choose an analytics function to run: \n 1. Shortest game \n 2. Number of checks \n 3. Most frequent opening \n 4. Most common three-move sequence \n 5. Least common three-move sequence \n 6. Top openings \n 7. Most common three-move sequences \n 8. Least common three-move sequences \n")
     if choice == '1':
         shortest_game = analytics_functions.shortest_game()
         print(f"Shortest game: {shortest_game['game_id']}, Turns: {shortest_game['number_of_turns']}")
@@ -66,5 +116,16 @@ if __name__ == "__main__":
     elif choice == '5':
         least_common_three_move_sequence = analytics_functions.least_common_three_move_sequence()
         print(f"Least common three-move sequence: {least_common_three_move_sequence['sequence']}, Count: {least_common_three_move_sequence['count']}")
+    elif choice == '6':
+        for opening in analytics_functions.top_openings():
+            print(f"Opening: {opening['opening']}, Count: {opening['count']}, White wins: {opening['white_win_rate']:.1%}")
+    elif choice == '7':
+        k = int(input("Enter the number of sequences: "))
+        for sequence in analytics_functions.most_common_three_move_sequence(k):
+            print(f"Sequence: {sequence['sequence']}, Count: {sequence['count']}")
+    elif choice == '8':
+        k = int(input("Enter the number of sequences: "))
+        for sequence in analytics_functions.least_common_three_move_sequence(k):
+            print(f"Sequence: {sequence['sequence']}, Count: {sequence['count']}")
     else:
         print("Invalid choice.")
\ No newline at end of file
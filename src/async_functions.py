@@ -0,0 +1,271 @@
+"""
+asyncio counterparts of the query classes, with the same method names and results.
+
+They share one redis.asyncio client (Config.get_async_redis_connection), so a single process
+can serve many concurrent requests; reads that do not depend on each other are pipelined or
+awaited together rather than issued one at a time.
+"""
+from analytics_functions import opening_count, queue_top_openings, ranked_sequences, ranked_sequences_stop, top_opening_stats
+from config import Config
+from game_functions import LINE_SCRIPT, build_search, line_search, queue_search_count, queue_search_page, search_expired, search_page
+from game_store import MOVE_GENERATION_KEY, MOVE_SAN_KEY, SEQUENCES_KEY, GameRecord, MoveDictionary
+from graph_functions import expand_level, hop_games, join_path, queue_friends_of_friends, queue_hop_games, queue_opponents, smaller_side
+from leaderboard_functions import player_rank, queue_player_rank
+from match_history import HISTORY_SCRIPT, history_args, history_page, pair_history_key, player_history_key
+from opening_tree import POSTING_DEPTH, node_key, opening_stats, queue_continuations, queue_opening_node
+from player_functions import email_candidates, player_opening_stats, players_by_email, queue_player_top_openings
+from union_find import FIND_SCRIPT, PARENT_KEY, SIZE_KEY, SIZES_KEY
+import asyncio
+import time
+
+# Registered with the first client that runs it; redis.asyncio scripts are a separate class
+_find_script = None
+
+async def find_roots(r, players):
+    global _find_script
+    if not players:
+        return []
+    if _find_script is None:
+        _find_script = r.register_script(FIND_SCRIPT)
+    return await _find_script(keys=[PARENT_KEY], args=players, client=r)
+
+class AsyncPlayerFunctions:
+    def __init__(self):
+        self.r = Config.get_async_redis_connection()
+
+    async def view_match_history(self, user_id):
+        return await self.r.smembers(f'player:{user_id}:games')
+
+    async def view_scheduled_games(self, user_id):
+        return await self.r.smembers(f'player:{user_id}:scheduled_games')
+
+    async def find_player_by_email(self, email):
+        if not await self.r.execute_command('BF.EXISTS', 'email_filter', email):
+            return None
+        return await self.r.get(f'email_user:{email}')
+
+    async def find_players_by_emails(self, emails):
+        emails = list(emails)
+        if not emails:
+            return {}
+        candidates = email_candidates(emails, await self.r.execute_command('BF.MEXISTS', 'email_filter', *emails))
+        user_ids = await self.r.mget([f'email_user:{email}' for email in candidates]) if candidates else []
+        return players_by_email(emails, candidates, user_ids)
+
+    async def get_games_between_players(self, player1_id, player2_id):
+        return await self.r.sunion(f'player_versus:{player1_id}:{player2_id}', f'player_versus:{player2_id}:{player1_id}')
+
+    async def get_match_history(self, user_id, cursor=0, count=20, colour=None, result=None, victory_status=None, opening=None):
+        return await self._history_page(player_history_key(user_id), history_args(user_id, cursor, count, colour, result, victory_status, opening))
+
+    async def get_match_history_between(self, player1_id, player2_id, cursor=0, count=20, colour=None, result=None, victory_status=None, opening=None):
+        return await self._history_page(pair_history_key(player1_id, player2_id), history_args(player1_id, cursor, count, colour, result, victory_status, opening))
+
+    async def _history_page(self, key, args):
+        return history_page(await self.r.register_script(HISTORY_SCRIPT)(keys=[key], args=args))
+
+    async def get_player_most_used_opening(self, user_id):
+        most_used = await self.r.zrevrange(f'player:{user_id}:opening_counts', 0, 0)
+        return most_used[0] if most_used else None
+
+    async def get_player_top_openings(self, user_id, limit=5):
+        pipe = self.r.pipeline(transaction=False)
+        queue_player_top_openings(pipe, user_id, limit)
+        return player_opening_stats(await pipe.execute())
+
+    async def get_player_top_sequences(self, user_id, limit=10):
+        sequences = await self.r.zrevrange(f'player:{user_id}:sequence_counts', 0, limit - 1, withscores=True)
+        return [{'sequence': sequence, 'count': int(count)} for sequence, count in sequences]
+
+class AsyncGameFunctions:
+    def __init__(self):
+        self.r = Config.get_async_redis_connection()
+        # Only used for decoding; the dictionary is loaded asynchronously before any decode
+        self.move_dictionary = MoveDictionary(None)
+        self.line_script = self.r.register_script(LINE_SCRIPT)
+
+    async def get_game(self, game_id):
+        return (await self.get_games([game_id]))[0]
+
+    async def get_games(self, game_ids):
+        game_ids = list(game_ids)
+        pipe = self.r.pipeline(transaction=False)
+        pipe.get(MOVE_GENERATION_KEY)
+        for game_id in game_ids:
+            pipe.hgetall(f'game:{game_id}')
+        generation, *results = await pipe.execute()
+        self.move_dictionary.check_generation(generation)
+        games = [GameRecord(game_id, fields, self.move_dictionary) if fields else None for game_id, fields in zip(game_ids, results)]
+        if any(game is not None and self.move_dictionary.is_missing(game._packed_moveset) for game in games):
+            self.move_dictionary.load(await self.r.hgetall(MOVE_SAN_KEY))
+        return games
+
+    async def search_sequence_in_player_games(self, player_id, move1, move2, move3):
+        return list(await self.r.sinter(f'sequence:{move1}>{move2}>{move3}:games', f'player:{player_id}:games'))
+
+    async def search_sequence_in_all_games(self, move1, move2, move3):
+        return list(await self.r.smembers(f'sequence:{move1}>{move2}>{move3}:games'))
+
+    async def count_sequence_in_player_games(self, player_id, move1, move2, move3):
+        return await self.count_games(sequences=[(move1, move2, move3)], players=[player_id])
+
+    async def count_sequence_in_all_games(self, move1, move2, move3):
+        return await self.r.scard(f'sequence:{move1}>{move2}>{move3}:games')
+
+    async def search_line(self, moves, start=None, player_id=None, cursor=0, count=100):
+        keys, args = line_search(moves, start, player_id)
+        next_cursor, games = await self.line_script(keys=keys, args=[cursor, count] + args)
+        return {'games': games, 'cursor': int(next_cursor)}
+
+    async def explore_opening(self, moves=(), limit=None):
+        pipe = self.r.pipeline(transaction=False)
+        queue_opening_node(pipe, moves, limit)
+        fields, continuations = await pipe.execute()
+        pipe = self.r.pipeline(transaction=False)
+        queue_continuations(pipe, moves, continuations)
+        return opening_stats(fields, continuations, await pipe.execute())
+
+    async def games_with_prefix(self, moves, cursor=0, count=100):
+        if not moves:
+            raise ValueError('games_with_prefix needs at least one move')
+        moves = list(moves)
+        cursor, game_ids = await self.r.sscan(f'{node_key(moves[:POSTING_DEPTH])}:games', cursor, count=count)
+        if len(moves) > POSTING_DEPTH:
+            game_ids = [game.game_id for game in await self.get_games(game_ids) if game is not None and game.moveset[:len(moves)] == moves]
+        return {'games': game_ids, 'cursor': cursor}
+
+    async def search_games(self, sequences=(), players=(), sequence_mode='and', player_mode='or', cursor=0, count=100):
+        key, queue_build = build_search(sequences, players, sequence_mode, player_mode)
+        pipe = self.r.pipeline(transaction=True)
+        queue_search_page(pipe, key, queue_build, cursor, count)
+        results = await pipe.execute()
+        if search_expired(queue_build, cursor, results):
+            pipe = self.r.pipeline(transaction=True)
+            queue_search_page(pipe, key, queue_build, cursor, count, rebuild=True)
+            results = await pipe.execute()
+        return search_page(results)
+
+    async def count_games(self, sequences=(), players=(), sequence_mode='and', player_mode='or'):
+        key, queue_build = build_search(sequences, players, sequence_mode, player_mode)
+        pipe = self.r.pipeline(transaction=True)
+        queue_search_count(pipe, key, queue_build)
+        return (await pipe.execute())[-1]
+
+class AsyncLeaderboardFunctions:
+    def __init__(self):
+        self.r = Config.get_async_redis_connection()
+
+    async def get_top_players(self, limit=10, offset=0):
+        top_players = await self.r.zrevrange('leaderboard:wins', offset, offset + limit - 1, withscores=True)
+        return [{'player_id': player_id, 'wins': int(wins)} for player_id, wins in top_players]
+
+    async def get_bottom_players(self, limit=10, offset=0):
+        bottom_players = await self.r.zrevrange('leaderboard:losses', offset, offset + limit - 1, withscores=True)
+        return [{'player_id': player_id, 'losses': int(losses)} for player_id, losses in bottom_players]
+
+    async def get_player_rank(self, player_id):
+        pipe = self.r.pipeline(transaction=False)
+        queue_player_rank(pipe, player_id)
+        return player_rank(player_id, await pipe.execute())
+
+class AsyncAnalyticsFunctions:
+    def __init__(self):
+        self.r = Config.get_async_redis_connection()
+
+    async def shortest_game(self):
+        game_id, number_of_turns = await self.r.mget('analytics:shortest_game', 'analytics:shortest_game_turns')
+        return {
+            'game_id': game_id,
+            'number_of_turns': number_of_turns
+        }
+
+    async def number_of_checks(self, game_id):
+        return int(await self.r.hget(f'game:{game_id}', 'check_count') or 0)
+
+    async def most_frequent_opening(self):
+        return opening_count(await self.r.zrevrange('openings', 0, 0, withscores=True))
+
+    async def top_openings(self, limit=10):
+        pipe = self.r.pipeline(transaction=False)
+        queue_top_openings(pipe, limit)
+        return top_opening_stats(await pipe.execute())
+
+    async def _ranked_sequences(self, k, most_common):
+        stop = ranked_sequences_stop(k)
+        if stop is None:
+            return []
+        rank = self.r.zrevrange if most_common else self.r.zrange
+        return ranked_sequences(k, await rank(SEQUENCES_KEY, 0, stop, withscores=True))
+
+    async def most_common_three_move_sequence(self, k=None):
+        return await self._ranked_sequences(k, most_common=True)
+
+    async def least_common_three_move_sequence(self, k=None):
+        return await self._ranked_sequences(k, most_common=False)
+
+class AsyncGraphQueries:
+    def __init__(self):
+        self.r = Config.get_async_redis_connection()
+
+    async def get_opponents(self, user_id):
+        return {opponent: int(games) for opponent, games in await self.r.zrange(f'player:{user_id}:opponents', 0, -1, withscores=True)}
+
+    async def get_friends_of_friends(self, user_id):
+        direct_opponents = await self.r.zrange(f'player:{user_id}:opponents', 0, -1)
+        if not direct_opponents:
+            return []
+        pipe = self.r.pipeline(transaction=True)
+        queue_friends_of_friends(pipe, user_id, direct_opponents)
+        return (await pipe.execute())[2]
+
+    async def stronger_foaf(self, user_id):
+        # The user's wins and their friends of friends do not depend on each other
+        user_wins, candidates = await asyncio.gather(self.r.zscore('leaderboard:wins', user_id), self.get_friends_of_friends(user_id))
+        user_wins = int(user_wins or 0)
+        pipe = self.r.pipeline(transaction=False)
+        for player in candidates:
+            pipe.zscore('leaderboard:wins', player)
+        return [player for player, wins in zip(candidates, await pipe.execute()) if int(wins or 0) > user_wins]
+
+    async def longest_connected_component(self):
+        largest = await self.r.zrevrange(SIZES_KEY, 0, 0, withscores=True)
+        if largest:
+            return int(largest[0][1])
+        return 1 if await self.r.scard('players') else 0
+
+    async def get_component(self, user_id):
+        return (await find_roots(self.r, [user_id]))[0]
+
+    async def get_component_size(self, user_id):
+        root = await self.get_component(user_id)
+        return int(await self.r.hget(SIZE_KEY, root)) if root is not None else 1
+
+    async def are_connected(self, player1_id, player2_id):
+        if player1_id == player2_id:
+            return True
+        root_1, root_2 = await find_roots(self.r, [player1_id, player2_id])
+        return root_1 is not None and root_1 == root_2
+
+    async def degrees_of_separation(self, player1_id, player2_id, max_depth=6, time_budget=None):
+        if player1_id == player2_id:
+            return {'players': [player1_id], 'games': []}
+        if not await self.are_connected(player1_id, player2_id):
+            return None
+        deadline = time.monotonic() + time_budget if time_budget is not None else None
+        parents = ({player1_id: None}, {player2_id: None})
+        frontiers = ([player1_id], [player2_id])
+        depth, meeting = 0, None
+        while meeting is None and frontiers[0] and frontiers[1] and depth < max_depth:
+            if deadline is not None and time.monotonic() > deadline:
+                return None
+            side = smaller_side(frontiers)
+            pipe = self.r.pipeline(transaction=False)
+            queue_opponents(pipe, frontiers[side])
+            frontiers, meeting = expand_level(parents, frontiers, side, await pipe.execute())
+            depth += 1
+        if meeting is None:
+            return None
+        path = join_path(parents, meeting)
+        pipe = self.r.pipeline(transaction=False)
+        queue_hop_games(pipe, path)
+        return {'players': path, 'games': hop_games(await pipe.execute())}
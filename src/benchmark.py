@@ -0,0 +1,207 @@
+"""
+Benchmark harness: loads a synthetic dataset with RedisChessLoader, then times every query
+method against the configured Redis (REDIS_HOST/REDIS_PORT/REDIS_DB), reporting throughput,
+p50/p99 latency, round trips per call (counted by the instrumented client) and memory, so
+changes can be compared run to run.
+
+The loader flushes the selected database, so point it at a scratch redis-server.
+"""
+from analytics_functions import AnalyticsFunctions
+from config import Config
+from game_functions import GameFunctions
+from graph_functions import GraphQueries
+from instrumentation import metrics
+from leaderboard_functions import LeaderboardFunctions
+from load_transform import RedisChessLoader
+from player_functions import PlayerFunctions
+from query_cache import QueryCache
+from synthetic_data import generate_dataset
+import argparse
+import contextlib
+import io
+import json
+import math
+import os
+import random
+import time
+
+def percentile(samples: list, p: float) -> float:
+    """Nearest-rank percentile of already sorted samples.
+    """
+    return samples[max(0, math.ceil(p / 100 * len(samples)) - 1)] if samples else 0.0
+
+def server_counters(r) -> dict:
+    return {
+        'commands': r.info('stats')['total_commands_processed'],
+        'used_memory': r.info('memory')['used_memory']
+    }
+
+def count_rows(path: str) -> int:
+    with open(path, 'rb') as csvfile:
+        return sum(1 for _ in csvfile) - 1
+
+def benchmark_ingest(loader: RedisChessLoader, processes: int = 1) -> list:
+    """Load players, schedules and game records, measuring each stage.
+    """
+    stages = [
+        ('players', loader.players_path, loader.load_players),
+        ('schedules', loader.schedule_path, loader.load_schedules),
+        ('game_records', loader.game_records_path, (lambda: loader.load_game_records_parallel(processes)) if processes > 1 else loader.load_game_records)
+    ]
+    results = []
+    for name, path, load in stages:
+        rows = count_rows(path)
+        before, round_trips = server_counters(loader.r), metrics.totals()['round_trips']
+        started = time.perf_counter()
+        load()
+        elapsed = time.perf_counter() - started
+        round_trips = metrics.totals()['round_trips'] - round_trips
+        after = server_counters(loader.r)
+        results.append({
+            'stage': name,
+            'rows': rows,
+            'seconds': elapsed,
+            'rows_per_sec': rows / elapsed if elapsed > 0 else 0.0,
+            # Requests from worker processes are not seen by this process's counter
+            'round_trips': round_trips,
+            'commands': after['commands'] - before['commands'],
+            'used_memory': after['used_memory']
+        })
+    return results
+
+def sample_arguments(r, game_functions: GameFunctions, count: int = 100, seed: int = 0) -> list:
+    """Pick players with at least one game of six or more moves, with one of their games,
+    its moves, its opponent and some other player, to use as query arguments.
+    """
+    rnd = random.Random(seed)
+    players = sorted(r.srandmember('players', count * 4) or [])
+    rnd.shuffle(players)
+    samples = []
+    for player in players:
+        game_id = r.srandmember(f'player:{player}:games')
+        game = game_functions.get_game(game_id) if game_id else None
+        if game is None or len(game.moveset) < 6:
+            continue
+        samples.append({'player': player, 'email': r.get(f'player:{player}'), 'game_id': game_id,
+                        'moves': game.moveset, 'opponent': game.opponent_of(player)})
+        if len(samples) == count:
+            break
+    if not samples:
+        raise RuntimeError('No loaded player has a game of six or more moves to benchmark with')
+    for i, sample in enumerate(samples):
+        neighbours = [samples[(i + j) % len(samples)] for j in range(1, 11)]
+        sample['other'] = neighbours[0]['player']
+        sample['emails'] = [sample['email']] + [neighbour['email'] for neighbour in neighbours]
+        sample['game_ids'] = [sample['game_id']] + [neighbour['game_id'] for neighbour in neighbours]
+    return samples
+
+def query_cases(cache: QueryCache = None) -> list:
+    """(name, call) for every query method; `call` takes one sample from `sample_arguments`.
+    """
+    players, games, leaderboards = PlayerFunctions(), GameFunctions(), LeaderboardFunctions(cache)
+    analytics, graph = AnalyticsFunctions(cache), GraphQueries()
+    return [
+        ('player.view_match_history', lambda s: players.view_match_history(s['player'])),
+        ('player.view_scheduled_games', lambda s: players.view_scheduled_games(s['player'])),
+        ('player.find_player_by_email', lambda s: players.find_player_by_email(s['email'])),
+        ('player.find_players_by_emails', lambda s: players.find_players_by_emails(s['emails'])),
+        ('player.get_games_between_players', lambda s: players.get_games_between_players(s['player'], s['opponent'])),
+        ('player.get_match_history', lambda s: players.get_match_history(s['player'])),
+        ('player.get_match_history_filtered', lambda s: players.get_match_history(s['player'], colour='black', result='loss')),
+        ('player.get_match_history_between', lambda s: players.get_match_history_between(s['player'], s['opponent'])),
+        ('player.get_player_most_used_opening', lambda s: players.get_player_most_used_opening(s['player'])),
+        ('player.get_player_top_openings', lambda s: players.get_player_top_openings(s['player'])),
+        ('player.get_player_top_sequences', lambda s: players.get_player_top_sequences(s['player'])),
+        ('game.get_game', lambda s: games.get_game(s['game_id']).moveset),
+        ('game.get_games', lambda s: [game.moveset for game in games.get_games(s['game_ids'])]),
+        ('game.search_sequence_in_player_games', lambda s: games.search_sequence_in_player_games(s['player'], *s['moves'][:3])),
+        ('game.search_sequence_in_all_games', lambda s: games.search_sequence_in_all_games(*s['moves'][:3])),
+        ('game.count_sequence_in_player_games', lambda s: games.count_sequence_in_player_games(s['player'], *s['moves'][:3])),
+        ('game.count_sequence_in_all_games', lambda s: games.count_sequence_in_all_games(*s['moves'][:3])),
+        ('game.search_line', lambda s: games.search_line(s['moves'][:6])),
+        ('game.explore_opening', lambda s: games.explore_opening(s['moves'][:2])),
+        ('game.games_with_prefix', lambda s: games.games_with_prefix(s['moves'][:4])),
+        ('game.search_games', lambda s: games.search_games(sequences=[s['moves'][:3], s['moves'][3:6]], players=[s['player']])),
+        ('game.count_games', lambda s: games.count_games(sequences=[s['moves'][:3]], players=[s['player'], s['opponent']])),
+        ('leaderboard.get_top_players', lambda s: leaderboards.get_top_players()),
+        ('leaderboard.get_bottom_players', lambda s: leaderboards.get_bottom_players()),
+        ('leaderboard.get_player_rank', lambda s: leaderboards.get_player_rank(s['player'])),
+        ('analytics.shortest_game', lambda s: analytics.shortest_game()),
+        ('analytics.number_of_checks', lambda s: analytics.number_of_checks(s['game_id'])),
+        ('analytics.most_frequent_opening', lambda s: analytics.most_frequent_opening()),
+        ('analytics.top_openings', lambda s: analytics.top_openings()),
+        ('analytics.most_common_three_move_sequence', lambda s: analytics.most_common_three_move_sequence()),
+        ('analytics.least_common_three_move_sequence', lambda s: analytics.least_common_three_move_sequence()),
+        ('analytics.most_common_three_move_sequences', lambda s: analytics.most_common_three_move_sequence(10)),
+        ('graph.get_opponents', lambda s: graph.get_opponents(s['player'])),
+        ('graph.get_friends_of_friends', lambda s: graph.get_friends_of_friends(s['player'])),
+        ('graph.stronger_foaf', lambda s: graph.stronger_foaf(s['player'])),
+        ('graph.longest_connected_component', lambda s: graph.longest_connected_component()),
+        ('graph.get_component_size', lambda s: graph.get_component_size(s['player'])),
+        ('graph.are_connected', lambda s: graph.are_connected(s['player'], s['other'])),
+        ('graph.degrees_of_separation', lambda s: graph.degrees_of_separation(s['player'], s['other'], time_budget=1))
+    ]
+
+def benchmark_queries(cases: list, samples: list, iterations: int = 200) -> list:
+    """Call every case `iterations` times, cycling through the samples, after one warm-up call.
+    """
+    results = []
+    # Some query methods print as they go
+    with contextlib.redirect_stdout(io.StringIO()):
+        for name, call in cases:
+            call(samples[0])
+            latencies, round_trips = [], metrics.totals()['round_trips']
+            for i in range(iterations):
+                started = time.perf_counter()
+                call(samples[i % len(samples)])
+                latencies.append(time.perf_counter() - started)
+            round_trips = metrics.totals()['round_trips'] - round_trips
+            latencies.sort()
+            total = sum(latencies)
+            results.append({
+                'query': name,
+                'calls': iterations,
+                'calls_per_sec': iterations / total if total > 0 else 0.0,
+                'p50_ms': percentile(latencies, 50) * 1000,
+                'p99_ms': percentile(latencies, 99) * 1000,
+                'round_trips_per_call': round_trips / iterations
+            })
+    return results
+
+def print_report(ingest: list, queries: list) -> None:
+    print(f"\n{'stage':<14}{'rows':>10}{'seconds':>10}{'rows/sec':>12}{'round trips':>13}{'commands':>12}{'memory MB':>11}")
+    for stage in ingest:
+        print(f"{stage['stage']:<14}{stage['rows']:>10}{stage['seconds']:>10.2f}{stage['rows_per_sec']:>12.0f}"
+              f"{stage['round_trips']:>13}{stage['commands']:>12}{stage['used_memory'] / 2 ** 20:>11.1f}")
+    print(f"\n{'query':<46}{'calls/sec':>11}{'p50 ms':>9}{'p99 ms':>9}{'trips/call':>12}")
+    for query in queries:
+        print(f"{query['query']:<46}{query['calls_per_sec']:>11.0f}{query['p50_ms']:>9.3f}{query['p99_ms']:>9.3f}{query['round_trips_per_call']:>12.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Load a synthetic dataset and benchmark ingest and every query method.')
+    parser.add_argument('--games', type=int, default=10000)
+    parser.add_argument('--players', type=int, default=None)
+    parser.add_argument('--schedules', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--data-dir', default=os.path.join(Config.BASE_DIR, 'data', 'synthetic'))
+    parser.add_argument('--processes', type=int, default=Config.INGEST_PROCESSES)
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--scripted', action='store_true', help='load game records with the server-side ingest script')
+    parser.add_argument('--cache', action='store_true', help='serve analytics and leaderboards through a QueryCache')
+    parser.add_argument('--output', help='also write the results to this JSON file')
+    parser.add_argument('--yes', action='store_true', help='flush the Redis database without asking')
+    args = parser.parse_args()
+
+    # Count round trips through the instrumented client
+    Config.REDIS_INSTRUMENT = True
+    paths = generate_dataset(args.data_dir, args.games, args.players, args.schedules, args.seed)
+    loader = RedisChessLoader(**paths, flush=True if args.yes else None, scripted=args.scripted)
+    ingest = benchmark_ingest(loader, args.processes)
+    cases = query_cases(QueryCache(loader.r) if args.cache else None)
+    queries = benchmark_queries(cases, sample_arguments(loader.r, GameFunctions(), seed=args.seed), args.iterations)
+    print_report(ingest, queries)
+    print('\n' + metrics.report())
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump({'games': args.games, 'seed': args.seed, 'ingest': ingest, 'queries': queries}, output, indent=2)
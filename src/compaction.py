@@ -0,0 +1,175 @@
+"""
+Migration to the compact counter layout, and a memory report.
+
+Older loads kept a string key per counter, which are now members of sorted sets:
+- `sequence:{sequence}`, the times each three-move sequence was played, is a score of `sequences`
+- `leaderboard:wins:{id}` and `leaderboard:losses:{id}` are scores of `leaderboard:wins` and
+  `leaderboard:losses`
+- `opening:{eco}`, the games played with each opening, is a score of `openings`
+- `player:{id}:opening:{eco}:count` is a score of `player:{id}:opening_counts`, replacing the
+  plain `player:{id}:openings` set
+Each game's check count, once `game:{game_id}:analytics:check_count`, lives in the game hash
+(see game_store.py). `migrate_counters` converts an existing database in batches; each batch
+adds its counts and deletes their keys in one MULTI, so the migration can be interrupted and
+rerun. Counts are added to what the sorted sets already hold from loads since the change.
+
+Run `python compaction.py` to migrate and print the memory per game before and after, or
+`python compaction.py report` for the report alone.
+"""
+from config import Config
+from game_store import MoveDictionary, SEQUENCES_KEY, migrate_games, scan_game_ids
+import logging
+import sys
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+handler = logging.StreamHandler()
+formatter = logging.Formatter('%(asctime)s — %(levelname)s — %(message)s')
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+
+# Keys the old loader derived from the counters, which nothing reads any more
+STALE_KEYS = ['leaderboard:top_players', 'leaderboard:bottom_players', 'analytics:most_frequent_opening',
+              'analytics:most_common_sequence', 'analytics:least_common_sequence']
+
+def scan_keys(r, pattern: str, batch_size: int = 500, colons: int = None):
+    """Yield the keys matching `pattern` in batches of up to `batch_size`, keeping only those
+    with `colons` colons when it is given.
+    """
+    batch = []
+    for key in r.scan_iter(match=pattern, count=batch_size):
+        if colons is None or key.count(':') == colons:
+            batch.append(key)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def migrate_string_counters(r, batches, target) -> int:
+    """Add the counts held in each batch of string keys to sorted sets and delete the keys.
+    `target` maps a key to the (sorted set, member) its count belongs to. Returns the number
+    of keys migrated.
+    """
+    migrated = 0
+    for keys in batches:
+        # MGET gives None for keys that are gone or are not strings; those are left alone
+        found = [(key, count) for key, count in zip(keys, r.mget(keys)) if count is not None]
+        if not found:
+            continue
+        pipe = r.pipeline(transaction=True)
+        for key, count in found:
+            name, member = target(key)
+            pipe.zincrby(name, int(count), member)
+        pipe.delete(*[key for key, _ in found])
+        pipe.execute()
+        migrated += len(found)
+    return migrated
+
+def migrate_sequence_counters(r, batch_size: int = 500) -> int:
+    """Move the sequence counters into `sequences`. Returns the number moved.
+    """
+    # Skip the sequence's :games and :positions indexes; SAN moves never contain ':'
+    return migrate_string_counters(r, scan_keys(r, 'sequence:*', batch_size, colons=1),
+                                   lambda key: (SEQUENCES_KEY, key.split(':', 1)[1]))
+
+def migrate_leaderboard_counters(r, batch_size: int = 500) -> int:
+    """Move the per-player win and loss counters into the leaderboards. Returns the number moved.
+    """
+    migrated = 0
+    for board in ('leaderboard:wins', 'leaderboard:losses'):
+        migrated += migrate_string_counters(r, scan_keys(r, f'{board}:*', batch_size),
+                                            lambda key, board=board: (board, key[len(board) + 1:]))
+    return migrated
+
+def migrate_opening_counters(r, batch_size: int = 500) -> int:
+    """Move the opening counters, global and per player, into the opening sorted sets and drop
+    the players' old opening sets. Returns the number of counters moved.
+    """
+    migrated = migrate_string_counters(r, scan_keys(r, 'opening:*', batch_size, colons=1),
+                                       lambda key: ('openings', key.split(':', 1)[1]))
+    migrated += migrate_string_counters(r, scan_keys(r, 'player:*:opening:*:count', batch_size),
+                                        lambda key: (f'{key.rsplit(":opening:", 1)[0]}:opening_counts', key[:-len(':count')].rsplit(':opening:', 1)[1]))
+    # Every count is in the sorted sets now, so the sets of each player's openings can go
+    for keys in scan_keys(r, 'player:*:openings', batch_size):
+        r.delete(*keys)
+    return migrated
+
+def migrate_check_counts(r, batch_size: int = 500) -> int:
+    """Move the per-game check count keys into the game hashes. Returns the number moved.
+    """
+    moved = 0
+    for game_ids in scan_game_ids(r, batch_size):
+        keys = [f'game:{game_id}:analytics:check_count' for game_id in game_ids]
+        counts = r.mget(keys)
+        found = [(game_id, key, count) for game_id, key, count in zip(game_ids, keys, counts) if count is not None]
+        if not found:
+            continue
+        pipe = r.pipeline(transaction=True)
+        for game_id, key, count in found:
+            pipe.hset(f'game:{game_id}', 'check_count', count)
+        pipe.delete(*[key for _, key, _ in found])
+        pipe.execute()
+        moved += len(found)
+    return moved
+
+def migrate_counters(r, batch_size: int = 500) -> dict:
+    """Convert every old counter key to the compact layout.
+    """
+    # Check counts go into the game hashes, so games still in the old JSON set layout go first
+    games = migrate_games(r, MoveDictionary(r), batch_size)
+    logger.info('Converted %d game records', games)
+    report = {
+        'game_records': games,
+        'sequence_counters': migrate_sequence_counters(r, batch_size),
+        'leaderboard_counters': migrate_leaderboard_counters(r, batch_size),
+        'opening_counters': migrate_opening_counters(r, batch_size),
+        'check_counts': migrate_check_counts(r, batch_size)
+    }
+    logger.info('Moved %d sequence, %d leaderboard and %d opening counters and %d check counts', report['sequence_counters'],
+                report['leaderboard_counters'], report['opening_counters'], report['check_counts'])
+    r.delete(*STALE_KEYS)
+    return report
+
+def memory_report(r, batch_size: int = 500, samples: int = 10000) -> dict:
+    """Memory, keys and their per-game averages of the database. The server's used_memory
+    covers every database, so the memory is estimated from the MEMORY USAGE of up to `samples`
+    of this database's keys instead.
+    """
+    games = sum(len(game_ids) for game_ids in scan_game_ids(r, batch_size))
+    keys = r.dbsize()
+    sampled, sample_memory = 0, 0
+    for batch in scan_keys(r, '*', batch_size):
+        batch = batch[:samples - sampled]
+        pipe = r.pipeline(transaction=False)
+        for key in batch:
+            pipe.memory_usage(key)
+        sample_memory += sum(usage or 0 for usage in pipe.execute())
+        sampled += len(batch)
+        if sampled >= samples:
+            break
+    used_memory = int(sample_memory * keys / sampled) if sampled else 0
+    return {
+        'games': games,
+        'keys': keys,
+        'used_memory': used_memory,
+        'bytes_per_game': used_memory / games if games else 0.0,
+        'keys_per_game': keys / games if games else 0.0
+    }
+
+def print_report(label: str, report: dict) -> None:
+    print(f"{label}: {report['games']} games, {report['keys']} keys, {report['used_memory'] / 2 ** 20:.1f} MB, "
+          f"{report['bytes_per_game']:.0f} bytes and {report['keys_per_game']:.1f} keys per game")
+
+
+if __name__ == "__main__":
+    r = Config.get_redis_connection()
+    before = memory_report(r)
+    print_report('Before', before)
+    if sys.argv[1:] == ['report']:
+        sys.exit(0)
+    migrate_counters(r)
+    after = memory_report(r)
+    print_report('After', after)
+    if before['bytes_per_game']:
+        print(f"Saved {1 - after['bytes_per_game'] / before['bytes_per_game']:.1%} of the memory per game")
@@ -1,6 +1,13 @@
+from instrumentation import InstrumentedRedis
 import logging
 import os
 import redis
+import threading
+
+try:
+    from redis.connection import HIREDIS_AVAILABLE, HiredisParser
+except ImportError:
+    HIREDIS_AVAILABLE = False
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -13,32 +20,135 @@ class Config:
     _REDIS_HOST = os.getenv('REDIS_HOST', 'localhost')
     _REDIS_PORT = int(os.getenv('REDIS_PORT', 6379))
     _REDIS_DB = int(os.getenv('REDIS_DB', 0))
+    # Database a reload is loaded into before it is swapped with the serving one
+    _REDIS_STAGING_DB = int(os.getenv('REDIS_STAGING_DB', _REDIS_DB + 1))
     _REDIS_PASSWORD = os.getenv('REDIS_PASSWORD', None)
-    _connection = redis.Redis(
-        host = _REDIS_HOST,
-        port = _REDIS_PORT,
-        db = _REDIS_DB,
-        password = _REDIS_PASSWORD,
-        decode_responses = True 
-    )
+    # Connection pool settings; timeouts are in seconds and unset means no timeout
+    _REDIS_MAX_CONNECTIONS = int(os.getenv('REDIS_MAX_CONNECTIONS', 50))
+    _REDIS_POOL_TIMEOUT = float(os.getenv('REDIS_POOL_TIMEOUT', 20))
+    _REDIS_SOCKET_TIMEOUT = float(os.getenv('REDIS_SOCKET_TIMEOUT')) if os.getenv('REDIS_SOCKET_TIMEOUT') else None
+    _REDIS_SOCKET_CONNECT_TIMEOUT = float(os.getenv('REDIS_SOCKET_CONNECT_TIMEOUT')) if os.getenv('REDIS_SOCKET_CONNECT_TIMEOUT') else None
+    _REDIS_HEALTH_CHECK_INTERVAL = int(os.getenv('REDIS_HEALTH_CHECK_INTERVAL', 30))
+    # Record commands, round trips and latency per calling method (see instrumentation.py)
+    REDIS_INSTRUMENT = bool(int(os.getenv('REDIS_INSTRUMENT', 0)))
+    # Created on first use and shared by every query class
+    _connection = None
+    _staging_connection = None
+    _async_connection = None
+    _connection_lock = threading.Lock()
     BASE_DIR = os.path.dirname(os.path.abspath(__file__)) + "/../"
     players_path = os.path.join(BASE_DIR, "data", "players.csv")
     schedule_path = os.path.join(BASE_DIR, "data", "schedule.csv")
     game_records_path = os.path.join(BASE_DIR, "data", "game_records.csv")
+    # Number of CSV rows read and written per pipeline during bulk ingest
+    INGEST_CHUNK_SIZE = int(os.getenv('INGEST_CHUNK_SIZE', 1000))
+    # Number of worker processes used to load game records (1 loads them serially)
+    INGEST_PROCESSES = int(os.getenv('INGEST_PROCESSES', 1))
+    # Apply each batch of game records with one server-side script call (see ingest_script.py)
+    INGEST_SCRIPT = bool(int(os.getenv('INGEST_SCRIPT', 0)))
+    # Game records per script call; the server runs nothing else while a script runs
+    INGEST_SCRIPT_BATCH_SIZE = int(os.getenv('INGEST_SCRIPT_BATCH_SIZE', 50))
+    # Retries of a batch whose WATCHed keys another loader changed, and the seconds the first
+    # retry waits at most (doubling per retry, with jitter)
+    INGEST_MAX_RETRIES = int(os.getenv('INGEST_MAX_RETRIES', 10))
+    INGEST_RETRY_BACKOFF = float(os.getenv('INGEST_RETRY_BACKOFF', 0.01))
+    # Email bloom filter: target false-positive rate, capacity reserved per expected player,
+    # and growth factor of each sub-filter added once the filter is full
+    EMAIL_FILTER_ERROR_RATE = float(os.getenv('EMAIL_FILTER_ERROR_RATE', 0.01))
+    EMAIL_FILTER_HEADROOM = float(os.getenv('EMAIL_FILTER_HEADROOM', 2))
+    EMAIL_FILTER_EXPANSION = int(os.getenv('EMAIL_FILTER_EXPANSION', 2))
+    # Query cache: maximum number of results kept, seconds a result may be served for, and
+    # seconds between checks of the data version written by the loader
+    QUERY_CACHE_SIZE = int(os.getenv('QUERY_CACHE_SIZE', 1024))
+    QUERY_CACHE_TTL = float(os.getenv('QUERY_CACHE_TTL', 300))
+    QUERY_CACHE_CHECK_INTERVAL = float(os.getenv('QUERY_CACHE_CHECK_INTERVAL', 1))
+    # Game stream ingest: worker processes, games read per batch, milliseconds a read blocks
+    # for, milliseconds an entry stays pending before another worker reclaims it, and the
+    # backlog at which producers wait
+    STREAM_WORKERS = int(os.getenv('STREAM_WORKERS', 4))
+    STREAM_BATCH_SIZE = int(os.getenv('STREAM_BATCH_SIZE', 100))
+    STREAM_BLOCK_MS = int(os.getenv('STREAM_BLOCK_MS', 1000))
+    STREAM_CLAIM_IDLE_MS = int(os.getenv('STREAM_CLAIM_IDLE_MS', 30000))
+    STREAM_MAX_BACKLOG = int(os.getenv('STREAM_MAX_BACKLOG', 100000))
+    # Workers apply their batches with the server-side ingest script unless this is 0
+    STREAM_INGEST_SCRIPT = bool(int(os.getenv('STREAM_INGEST_SCRIPT', 1)))
+
+    @classmethod
+    def _create_connection(cls, db):
+        """
+        Creates a client of database `db` backed by a blocking connection pool, which makes callers
+        wait for a free connection rather than open more than `_REDIS_MAX_CONNECTIONS` sockets
+        """
+        connection_kwargs = {}
+        if HIREDIS_AVAILABLE:
+            connection_kwargs['parser_class'] = HiredisParser
+        else:
+            logger.warning("hiredis is not installed, falling back to the Python response parser")
+        pool = redis.BlockingConnectionPool(
+            host = cls._REDIS_HOST,
+            port = cls._REDIS_PORT,
+            db = db,
+            password = cls._REDIS_PASSWORD,
+            decode_responses = True,
+            max_connections = cls._REDIS_MAX_CONNECTIONS,
+            timeout = cls._REDIS_POOL_TIMEOUT,
+            socket_timeout = cls._REDIS_SOCKET_TIMEOUT,
+            socket_connect_timeout = cls._REDIS_SOCKET_CONNECT_TIMEOUT,
+            health_check_interval = cls._REDIS_HEALTH_CHECK_INTERVAL,
+            **connection_kwargs
+        )
+        client_class = InstrumentedRedis if cls.REDIS_INSTRUMENT else redis.Redis
+        return client_class(connection_pool=pool)
 
     @classmethod
-    def get_redis_connection(cls):
+    def get_redis_connection(cls, check=False, staging=False):
         """
-        Returns a connection to the Redis database
+        Returns a connection to the Redis database, creating the shared connection pool on first use.
+        With `staging`, the connection is to the database reloads are loaded into instead of the
+        serving one. With `check`, the connection is PINGed first and None is returned if Redis is
+        unreachable.
         """
+        attribute = '_staging_connection' if staging else '_connection'
+        if getattr(cls, attribute) is None:
+            with cls._connection_lock:
+                if getattr(cls, attribute) is None:
+                    setattr(cls, attribute, cls._create_connection(cls._REDIS_STAGING_DB if staging else cls._REDIS_DB))
+        connection = getattr(cls, attribute)
+        if not check:
+            return connection
         try:
-            if cls._connection.ping():
-                logger.info(f"Successfully connected to redis:\n{cls._connection}")
-                return cls._connection
+            if connection.ping():
+                logger.info(f"Successfully connected to redis:\n{connection}")
+                return connection
         except redis.exceptions.ConnectionError as e:
             logger.error(f"Failed to connect to redis:\n{e}")
         return None
 
+    @classmethod
+    def get_async_redis_connection(cls):
+        """
+        Returns the shared asyncio Redis client, creating its connection pool on first use.
+        The pool has the same limits as the synchronous one; redis.asyncio picks the hiredis
+        parser by itself when it is installed.
+        """
+        if cls._async_connection is None:
+            # Imported here so that synchronous users never load the asyncio client
+            import redis.asyncio
+            pool = redis.asyncio.BlockingConnectionPool(
+                host = cls._REDIS_HOST,
+                port = cls._REDIS_PORT,
+                db = cls._REDIS_DB,
+                password = cls._REDIS_PASSWORD,
+                decode_responses = True,
+                max_connections = cls._REDIS_MAX_CONNECTIONS,
+                timeout = cls._REDIS_POOL_TIMEOUT,
+                socket_timeout = cls._REDIS_SOCKET_TIMEOUT,
+                socket_connect_timeout = cls._REDIS_SOCKET_CONNECT_TIMEOUT,
+                health_check_interval = cls._REDIS_HEALTH_CHECK_INTERVAL
+            )
+            cls._async_connection = redis.asyncio.Redis(connection_pool=pool)
+        return cls._async_connection
+
 if __name__ == '__main__':
     logger.info("Testing connection to redis...")
-    connection = Config.get_redis_connection()
+    connection = Config.get_redis_connection(check=True)
@@ -0,0 +1,113 @@
+from config import Config
+import json
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+handler = logging.StreamHandler()
+formatter = logging.Formatter('%(asctime)s — %(levelname)s — %(message)s')
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+
+# Scheduled game ids scored by the unix time they expire at
+DUE_KEY = 'scheduled_games:due'
+# Players of each queued game, needed to clean up their scheduled_games sets
+PLAYERS_KEY = 'scheduled_games:players'
+# Time a game is scheduled for before it is removed
+SCHEDULE_TTL = 72 * 3600
+
+# Claims up to ARGV[2] games due by ARGV[1] by pushing their due time to ARGV[3], so other
+# sweepers skip them and they come back if this sweeper dies before removing them.
+CLAIM_SCRIPT = """
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+for _, game_id in ipairs(due) do
+    redis.call('ZADD', KEYS[1], ARGV[3], game_id)
+end
+return due
+"""
+
+def queue_schedule_expiry(pipe, game_id: str, player_1: str, player_2: str, due: float) -> None:
+    """Queue the registration of a scheduled game's removal at `due` on `pipe`.
+    """
+    pipe.zadd(DUE_KEY, {game_id: due})
+    pipe.hset(PLAYERS_KEY, game_id, json.dumps([player_1, player_2]))
+
+def queue_remove_scheduled_game(pipe, game_id: str, player_1: str, player_2: str) -> None:
+    """Queue the removal of a scheduled game on `pipe`. Players passed as None (the game's
+    players entry was missing) have no scheduled_games set to clean up.
+    """
+    pipe.delete(f'scheduled_game:{game_id}')
+    pipe.srem("scheduled_games", game_id)
+    for player_id in (player_1, player_2):
+        if player_id is not None:
+            pipe.srem(f'player:{player_id}:scheduled_games', game_id)
+    pipe.zrem(DUE_KEY, game_id)
+    pipe.hdel(PLAYERS_KEY, game_id)
+
+class ExpiryQueue:
+    """Removes scheduled games once they are due. The queue lives in Redis, so any number of
+    sweepers can drain it concurrently and pending removals survive restarts.
+    """
+    def __init__(self, r=None, batch_size: int = 500, lease: float = 60):
+        self.r = r or Config.get_redis_connection()
+        self.batch_size = batch_size
+        # Seconds a claimed batch stays hidden from other sweepers
+        self.lease = lease
+        self.claim = self.r.register_script(CLAIM_SCRIPT)
+
+    def sweep_once(self) -> int:
+        """Remove one batch of due games. Returns the number removed.
+        """
+        now = time.time()
+        game_ids = self.claim(keys=[DUE_KEY], args=[now, self.batch_size, now + self.lease])
+        if not game_ids:
+            return 0
+        players = self.r.hmget(PLAYERS_KEY, game_ids)
+        pipe = self.r.pipeline(transaction=True)
+        for game_id, game_players in zip(game_ids, players):
+            player_1, player_2 = json.loads(game_players) if game_players else (None, None)
+            queue_remove_scheduled_game(pipe, game_id, player_1, player_2)
+        pipe.execute()
+        return len(game_ids)
+
+    def sweep(self) -> int:
+        """Remove every game that is currently due. Returns the number removed.
+        """
+        removed = 0
+        while True:
+            count = self.sweep_once()
+            removed += count
+            if count < self.batch_size:
+                return removed
+
+    def depth(self) -> int:
+        """Number of scheduled games waiting to be removed.
+        """
+        return self.r.zcard(DUE_KEY)
+
+    def lag(self) -> float:
+        """Seconds the oldest due game has been waiting past its due time (0 if none is due).
+        """
+        oldest = self.r.zrange(DUE_KEY, 0, 0, withscores=True)
+        if not oldest:
+            return 0.0
+        return max(0.0, time.time() - oldest[0][1])
+
+    def run(self, interval: float = 1) -> None:
+        """Sweep forever, checking for due games every `interval` seconds.
+        """
+        while True:
+            removed = self.sweep()
+            if removed:
+                logger.info('Removed %d scheduled games (queue depth %d, lag %.1fs)', removed, self.depth(), self.lag())
+            time.sleep(interval)
+
+
+if __name__ == "__main__":
+    queue = ExpiryQueue()
+    logger.info("Sweeping scheduled games (queue depth %d, lag %.1fs). Use ^C to exit.", queue.depth(), queue.lag())
+    try:
+        queue.run()
+    except (KeyboardInterrupt, SystemExit):
+        logger.info("Sweeper shut down")
@@ -1,17 +1,163 @@
 from config import Config
+from game_store import SEQUENCES_KEY, MoveDictionary, get_games, migrate_games, moveset_sequences, scan_game_ids
+from opening_tree import POSTING_DEPTH, node_key, opening_stats, queue_continuations, queue_opening_node, queue_opening_tree
+import hashlib
+import sys
+
+# Seconds a stored search result is kept for paging
+SEARCH_TTL = 60
+
+def line_sequences(moves):
+    """Map each distinct three-move sequence of a line to its offsets within the line.
+    """
+    sequences = {}
+    for offset, sequence in enumerate(f'{moves[i]}>{moves[i+1]}>{moves[i+2]}' for i in range(len(moves) - 2)):
+        sequences.setdefault(sequence, []).append(offset)
+    return sequences
+
+# KEYS: the set of candidate games to scan, the positions hash of each of the line's sequences,
+# then the postings to intersect into the candidate set (none when it is a posting itself).
+# ARGV: the SSCAN cursor and count, SEARCH_TTL, the ply the line must start at ('' for anywhere),
+# then each sequence's comma-separated offsets within the line.
+# Returns the next cursor and the scanned candidates whose sequences line up one after another.
+LINE_SCRIPT = """
+local cursor, count, ttl, start = ARGV[1], ARGV[2], ARGV[3], ARGV[4]
+local sequences = #ARGV - 4
+if #KEYS > sequences + 1 then
+    -- Build the candidates on the first page, and again if they expired between pages
+    if cursor == '0' or redis.call('EXISTS', KEYS[1]) == 0 then
+        redis.call('SINTERSTORE', KEYS[1], unpack(KEYS, sequences + 2))
+    end
+    redis.call('EXPIRE', KEYS[1], ttl)
+end
+local scan = redis.call('SSCAN', KEYS[1], cursor, 'COUNT', count)
+local games = {}
+for _, game_id in ipairs(scan[2]) do
+    -- Plies the whole line could start at in this game
+    local starts
+    for i = 1, sequences do
+        local positions = redis.call('HGET', KEYS[i + 1], game_id) or ''
+        for offset in string.gmatch(ARGV[i + 4], '%d+') do
+            local line_starts = {}
+            for position in string.gmatch(positions, '%d+') do
+                local line_start = tonumber(position) - tonumber(offset)
+                if not starts or starts[line_start] then
+                    line_starts[line_start] = true
+                end
+            end
+            starts = line_starts
+        end
+    end
+    if (start == '' and next(starts)) or (start ~= '' and starts[tonumber(start)]) then
+        games[#games + 1] = game_id
+    end
+end
+return {scan[1], games}
+"""
+
+def line_search(moves, start=None, player_id=None):
+    """Return the LINE_SCRIPT keys, and its arguments after the cursor and count, for a line search.
+    """
+    if len(moves) < 3:
+        raise ValueError('search_line needs at least three moves')
+    sequences = line_sequences(moves)
+    position_keys = [f'sequence:{sequence}:positions' for sequence in sequences]
+    args = [SEARCH_TTL, '' if start is None else start] + [','.join(map(str, offsets)) for offsets in sequences.values()]
+    postings = [f'sequence:{sequence}:games' for sequence in sequences]
+    if player_id is not None:
+        postings.append(f'player:{player_id}:games')
+    if len(postings) == 1:
+        # A single posting list can be scanned directly
+        return postings + position_keys, args
+    key = 'search:line:' + hashlib.sha1(repr(postings).encode()).hexdigest()
+    return [key] + position_keys + postings, args
+
+def build_search(sequences, players, sequence_mode, player_mode):
+    """Return the key holding a search's result and a function queueing the commands that build
+    it on a pipeline (None when the result is an existing posting list).
+    """
+    sequence_keys = [f'sequence:{s if isinstance(s, str) else ">".join(s)}:games' for s in sequences]
+    player_keys = [f'player:{player_id}:games' for player_id in players]
+    groups = [(sequence_keys, sequence_mode), (player_keys, player_mode)]
+    groups = [(keys, mode) for keys, mode in groups if keys]
+    if not groups:
+        raise ValueError('search_games needs at least one sequence or player')
+    for _, mode in groups:
+        if mode not in ('and', 'or'):
+            raise ValueError(f'Unknown search mode {mode}')
+    if len(groups) == 1 and len(groups[0][0]) == 1:
+        # A single posting list can be scanned directly
+        return groups[0][0][0], None
+    key = 'search:' + hashlib.sha1(repr(groups).encode()).hexdigest()
+
+    def queue_build(pipe):
+        if len(groups) == 1:
+            keys, mode = groups[0]
+            (pipe.sinterstore if mode == 'and' else pipe.sunionstore)(key, keys)
+        else:
+            group_keys, temporary_keys = [], []
+            for i, (keys, mode) in enumerate(groups):
+                if len(keys) == 1:
+                    group_keys.append(keys[0])
+                    continue
+                group_key = f'{key}:{i}'
+                (pipe.sinterstore if mode == 'and' else pipe.sunionstore)(group_key, keys)
+                group_keys.append(group_key)
+                temporary_keys.append(group_key)
+            pipe.sinterstore(key, group_keys)
+            if temporary_keys:
+                pipe.delete(*temporary_keys)
+        pipe.expire(key, SEARCH_TTL)
+    return key, queue_build
+
+def queue_search_page(pipe, key, queue_build, cursor, count, rebuild=False):
+    """Queue the reads of one page of a search from `build_search`, building its stored result
+    first on the first page (or with `rebuild`) and otherwise keeping it for another SEARCH_TTL.
+    """
+    if queue_build is not None:
+        if cursor == 0 or rebuild:
+            queue_build(pipe)
+        else:
+            pipe.expire(key, SEARCH_TTL)
+    pipe.sscan(key, cursor, count=count)
+    pipe.scard(key)
+
+def search_expired(queue_build, cursor, results):
+    """Whether the stored result of a search expired before this page was read.
+    """
+    return queue_build is not None and cursor != 0 and not results[0]
+
+def search_page(results):
+    """Format the replies to `queue_search_page` as a page of search_games.
+    """
+    (next_cursor, games), total = results[-2], results[-1]
+    return {'games': games, 'cursor': next_cursor, 'total': total}
+
+def queue_search_count(pipe, key, queue_build):
+    """Queue the count of a search's results; it is the last reply.
+    """
+    if queue_build is not None:
+        queue_build(pipe)
+    pipe.scard(key)
 
 class GameFunctions:
     def __init__(self):
         self.r = Config.get_redis_connection()
+        self.move_dictionary = MoveDictionary(self.r)
+        self.line_script = self.r.register_script(LINE_SCRIPT)
+
+    def get_game(self, game_id):
+        return self.get_games([game_id])[0]
+
+    def get_games(self, game_ids):
+        # One round trip for all games; movesets are unpacked on first access
+        return get_games(self.r, self.move_dictionary, list(game_ids))
 
     def search_sequence_in_player_games(self, player_id, move1, move2, move3):
         sequence = f'{move1}>{move2}>{move3}'
 
-        all_games_with_sequence = self.r.smembers(f'sequence:{sequence}:games')
-        player_games = self.r.smembers(f'player:{player_id}:games')
-        
-        result_games = all_games_with_sequence.intersection(player_games)
-        return list(result_games)
+        # Intersect server-side so only the matching games are transferred
+        return list(self.r.sinter(f'sequence:{sequence}:games', f'player:{player_id}:games'))
     
     def search_sequence_in_all_games(self, move1, move2, move3):
 
@@ -19,13 +165,147 @@ class GameFunctions:
         games = self.r.smembers(f'sequence:{sequence}:games')
         
         return list(games)
+
+    def count_sequence_in_player_games(self, player_id, move1, move2, move3):
+        return self.count_games(sequences=[(move1, move2, move3)], players=[player_id])
+
+    def count_sequence_in_all_games(self, move1, move2, move3):
+        return self.r.scard(f'sequence:{move1}>{move2}>{move3}:games')
+
+    """
+    Finds games containing a contiguous line of three or more moves, optionally only those playing
+    it from ply `start` (0 for the first move) and only games of `player_id`, one page at a time.
+    Candidates come from intersecting the postings of the line's sequences into a set kept for
+    SEARCH_TTL seconds; each page scans `count` of them and checks their positions server-side,
+    so only matching game ids are transferred. Pages may be short; the cursor is 0 when done.
+    """
+    def search_line(self, moves, start=None, player_id=None, cursor=0, count=100):
+        keys, args = line_search(moves, start, player_id)
+        next_cursor, games = self.line_script(keys=keys, args=[cursor, count] + args)
+        return {'games': games, 'cursor': int(next_cursor)}
+
+    """
+    Opening explorer: returns how many games started with `moves`, their results, and the same
+    statistics for each move played next (most played first, at most `limit` of them). Moves
+    beyond TREE_DEPTH plies are not in the tree.
+    """
+    def explore_opening(self, moves=(), limit=None):
+        pipe = self.r.pipeline(transaction=False)
+        queue_opening_node(pipe, moves, limit)
+        fields, continuations = pipe.execute()
+        pipe = self.r.pipeline(transaction=False)
+        queue_continuations(pipe, moves, continuations)
+        return opening_stats(fields, continuations, pipe.execute())
+
+    """
+    Returns one page of the games that started with `moves` and the cursor of the next page
+    (0 when done). Prefixes longer than POSTING_DEPTH are answered from the posting of their
+    first POSTING_DEPTH moves and checked against the stored movesets, so pages may be short.
+    """
+    def games_with_prefix(self, moves, cursor=0, count=100):
+        if not moves:
+            raise ValueError('games_with_prefix needs at least one move')
+        moves = list(moves)
+        cursor, game_ids = self.r.sscan(f'{node_key(moves[:POSTING_DEPTH])}:games', cursor, count=count)
+        if len(moves) > POSTING_DEPTH:
+            game_ids = [game.game_id for game in self.get_games(game_ids) if game is not None and game.moveset[:len(moves)] == moves]
+        return {'games': game_ids, 'cursor': cursor}
+
+    """
+    Rebuilds the opening tree from the stored games, for data loaded before it was maintained
+    at ingest.
+    """
+    def backfill_opening_tree(self, batch_size=500):
+        stale = list(self.r.scan_iter(match='opening_tree:*', count=batch_size))
+        for i in range(0, len(stale), batch_size):
+            self.r.delete(*stale[i:i + batch_size])
+        for game_ids in scan_game_ids(self.r, batch_size):
+            pipe = self.r.pipeline(transaction=False)
+            for game in self.get_games(game_ids):
+                if game is not None:
+                    queue_opening_tree(pipe, game.game_id, game.moveset, game.winner)
+            pipe.execute()
+
+    """
+    Builds the positional sequence index from the stored games, for data loaded before it was
+    maintained at ingest. Safe to run more than once.
+    """
+    def backfill_sequence_positions(self, batch_size=500):
+        for game_ids in scan_game_ids(self.r, batch_size):
+            pipe = self.r.pipeline(transaction=False)
+            for game in self.get_games(game_ids):
+                if game is None:
+                    continue
+                for sequence, sequence_positions in moveset_sequences(game.moveset).items():
+                    pipe.hset(f'sequence:{sequence}:positions', game.game_id, ','.join(map(str, sequence_positions)))
+            pipe.execute()
+
+    """
+    Rebuilds the ranked sequence counts, globally and per player, from the stored games, for
+    data loaded before they were kept in sorted sets. Also drops the plain `player:{id}:sequences`
+    sets older loads kept. Safe to run more than once.
+    """
+    def backfill_sequence_ranks(self, batch_size=500):
+        stale = [SEQUENCES_KEY]
+        for pattern in ('player:*:sequence_counts', 'player:*:sequences'):
+            stale.extend(self.r.scan_iter(match=pattern, count=batch_size))
+        for i in range(0, len(stale), batch_size):
+            self.r.delete(*stale[i:i + batch_size])
+        for game_ids in scan_game_ids(self.r, batch_size):
+            pipe = self.r.pipeline(transaction=False)
+            for game in self.get_games(game_ids):
+                if game is None:
+                    continue
+                for sequence, sequence_positions in moveset_sequences(game.moveset).items():
+                    pipe.zincrby(SEQUENCES_KEY, len(sequence_positions), sequence)
+                    pipe.zincrby(f'player:{game.white_player_id}:sequence_counts', len(sequence_positions), sequence)
+                    pipe.zincrby(f'player:{game.black_player_id}:sequence_counts', len(sequence_positions), sequence)
+            pipe.execute()
+
+    """
+    Searches games by three-move sequences and players, one page at a time.
+    `sequences` are (move1, move2, move3) tuples or 'move1>move2>move3' strings and are combined
+    with `sequence_mode` ('and' / 'or'); `players` are combined with `player_mode`, and the two
+    groups are intersected. The result set is built server-side and kept for SEARCH_TTL seconds,
+    so paging through it with the returned cursor (0 when done) never transfers more than a page.
+    Like SSCAN, a game may occasionally be returned on more than one page.
+    """
+    def search_games(self, sequences=(), players=(), sequence_mode='and', player_mode='or', cursor=0, count=100):
+        key, queue_build = build_search(sequences, players, sequence_mode, player_mode)
+        pipe = self.r.pipeline(transaction=True)
+        queue_search_page(pipe, key, queue_build, cursor, count)
+        results = pipe.execute()
+        if search_expired(queue_build, cursor, results):
+            # The stored result expired between pages; rebuild it and carry on
+            pipe = self.r.pipeline(transaction=True)
+            queue_search_page(pipe, key, queue_build, cursor, count, rebuild=True)
+            results = pipe.execute()
+        return search_page(results)
+
+    def count_games(self, sequences=(), players=(), sequence_mode='and', player_mode='or'):
+        key, queue_build = build_search(sequences, players, sequence_mode, player_mode)
+        pipe = self.r.pipeline(transaction=True)
+        queue_search_count(pipe, key, queue_build)
+        return pipe.execute()[-1]
+
     
 if __name__ == "__main__":
+    if sys.argv[1:] == ['migrate']:
+        game_functions = GameFunctions()
+        converted = migrate_games(game_functions.r, game_functions.move_dictionary)
+        print(f"Converted {converted} game records")
+        sys.exit(0)
+    if sys.argv[1:] == ['backfill']:
+        game_functions = GameFunctions()
+        game_functions.backfill_sequence_positions()
+        game_functions.backfill_sequence_ranks()
+        game_functions.backfill_opening_tree()
+        sys.exit(0)
     
     user_id = input("Player functions. \n enter username: ")
     game_functions = GameFunctions()
 
-    choice = input("Choose an option: \n 1. Search for a sequence in a player's games, \n 2. Search for a sequence in all games \n")
+    choice = input("Choose an option: \n 1. Search for a sequence in a player's games, \n 2. Search for a sequence in all games \n 3. View a game \n 4. Search for a line of moves \n 5. Explore an opening \n")
     if choice == '2':
         move1 = input("Enter the first move: ")
         move2 = input("Enter the second move: ")
@@ -43,5 +323,28 @@ if __name__ == "__main__":
         
         games_with_sequence = game_functions.search_sequence_in_player_games(user_id, move1, move2, move3)
         print(f"Games with sequence {move1} > {move2} > {move3}: {', '.join(games_with_sequence)}")
+
+    elif choice == '3':
+        game = game_functions.get_game(input("Enter the game ID: "))
+        print(game.to_dict() if game else "Game not found")
+
+    elif choice == '4':
+        moves = input("Enter the moves separated by spaces: ").split()
+        start = input("Enter the ply the line starts at (blank for anywhere): ")
+        games_with_line, cursor = [], 0
+        while True:
+            page = game_functions.search_line(moves, start=int(start) if start else None, cursor=cursor)
+            games_with_line.extend(page['games'])
+            cursor = page['cursor']
+            if not cursor:
+                break
+        print(f"Games with line {' > '.join(moves)}: {', '.join(games_with_line)}")
+
+    elif choice == '5':
+        moves = input("Enter the opening moves separated by spaces: ").split()
+        opening = game_functions.explore_opening(moves, limit=10)
+        print(f"{opening['games']} games (white {opening['white']}, black {opening['black']}, draw {opening['draw']})")
+        for continuation in opening['continuations']:
+            print(f"  {continuation['move']}: {continuation['games']} games (white {continuation['white']}, black {continuation['black']}, draw {continuation['draw']})")
     else:
         print("Invalid choice.")
\ No newline at end of file
@@ -0,0 +1,217 @@
+"""
+Compact storage of game records.
+
+Each game is a hash at `game:{game_id}` holding the record's fields, with the moveset packed
+as one character per move: the character's code point is the move's index in an interned
+move dictionary (`moves:index` maps SAN -> index, `moves:san` maps index -> SAN). The packed
+string is valid text, so it round-trips through the decoded Redis connection and costs one
+byte per move for the most common moves. The game's count of checks is a field of the same
+hash.
+
+Indexes are only meaningful within one dictionary, and a flush and reload or a SWAPDB can
+replace it under a running process. Every dictionary has a random generation at
+`moves:generation`, written when its first move is interned, and readers drop their local
+copy of the dictionary when it changes.
+
+The count of times each three-move sequence was played is its score in the `sequences` sorted
+set, which also ranks them, rather than a key of its own.
+"""
+import json
+import uuid
+
+MOVE_INDEX_KEY = 'moves:index'
+MOVE_SAN_KEY = 'moves:san'
+MOVE_GENERATION_KEY = 'moves:generation'
+# Three-move sequences ranked by the number of times they were played in all games
+SEQUENCES_KEY = 'sequences'
+# Code points from here on are UTF-16 surrogates and cannot be encoded
+MAX_MOVES = 0xD800
+
+# Returns the dictionary's generation, setting it to ARGV[1] if it has none, then the index of
+# every other move in ARGV, assigning the next free index to unseen moves.
+INTERN_SCRIPT = """
+redis.call('SET', KEYS[3], ARGV[1], 'NX')
+local indexes = {redis.call('GET', KEYS[3])}
+for i = 2, #ARGV do
+    local move = ARGV[i]
+    local index = redis.call('HGET', KEYS[1], move)
+    if not index then
+        index = redis.call('HLEN', KEYS[1])
+        redis.call('HSET', KEYS[1], move, index)
+        redis.call('HSET', KEYS[2], index, move)
+    end
+    indexes[i] = tonumber(index)
+end
+return indexes
+"""
+
+def new_generation() -> str:
+    return uuid.uuid4().hex
+
+class MoveDictionary:
+    """Process-local copy of the interned move dictionary.
+    """
+    def __init__(self, r):
+        self.r = r
+        self.indexes = dict()
+        self.moves = dict()
+        # Generation of the dictionary this copy was taken from
+        self.generation = None
+
+    def check_generation(self, generation: str) -> bool:
+        """Drop this copy if it was taken from another dictionary than `generation`'s.
+        Returns whether it was dropped.
+        """
+        if generation == self.generation:
+            return False
+        self.generation = generation
+        dropped = bool(self.indexes or self.moves)
+        self.indexes, self.moves = dict(), dict()
+        return dropped
+
+    def intern(self, moves) -> None:
+        """Make sure every move in `moves` has an index, in at most one round trip (two if the
+        dictionary was replaced since this copy was taken).
+        """
+        moves = set(moves)
+        unseen = [move for move in moves if move not in self.indexes]
+        if not unseen:
+            return
+        generation, *indexes = self.r.register_script(INTERN_SCRIPT)(keys=[MOVE_INDEX_KEY, MOVE_SAN_KEY, MOVE_GENERATION_KEY], args=[new_generation()] + unseen)
+        if self.check_generation(generation):
+            return self.intern(moves)
+        for move, index in zip(unseen, indexes):
+            if index >= MAX_MOVES:
+                raise ValueError(f'Move dictionary is full, cannot index {move}')
+            self.indexes[move] = index
+            self.moves[index] = move
+
+    def encode(self, moveset: list) -> str:
+        """Pack a moveset whose moves have all been interned.
+        """
+        return ''.join(chr(self.indexes[move]) for move in moveset)
+
+    def is_missing(self, packed: str) -> bool:
+        """Whether a packed moveset has moves this copy of the dictionary has not seen.
+        """
+        return any(ord(char) not in self.moves for char in packed)
+
+    def load(self, san_by_index: dict) -> None:
+        """Add the contents of the `moves:san` hash to this copy of the dictionary.
+        """
+        self.moves.update((int(index), move) for index, move in san_by_index.items())
+
+    def decode(self, packed: str) -> list:
+        """Unpack a moveset, loading the dictionary from Redis if it has moves we have not seen.
+        """
+        if self.is_missing(packed):
+            self.load(self.r.hgetall(MOVE_SAN_KEY))
+        return [self.moves[ord(char)] for char in packed]
+
+def moveset_sequences(moveset: list) -> dict:
+    """Map the three-move sequences of a moveset, in order of first appearance, to the
+    positions (index of the first move) they start at.
+    """
+    sequences = dict()
+    for i in range(len(moveset) - 2):
+        sequence = f'{moveset[i]}>{moveset[i+1]}>{moveset[i+2]}'
+        sequences.setdefault(sequence, []).append(i)
+    return sequences
+
+class GameRecord:
+    """A stored game record; the moveset is only unpacked when it is first read.
+    """
+    def __init__(self, game_id: str, fields: dict, move_dictionary: MoveDictionary):
+        self.game_id = game_id
+        self.winner = fields['winner']
+        self.victory_status = fields['victory_status']
+        self.number_of_turns = int(fields['number_of_turns'])
+        self.white_player_id = fields['white_player_id']
+        self.black_player_id = fields['black_player_id']
+        self.opening_eco = fields['opening_eco']
+        self._packed_moveset = fields['moves']
+        self._move_dictionary = move_dictionary
+        self._moveset = None
+
+    @property
+    def moveset(self) -> list:
+        if self._moveset is None:
+            self._moveset = self._move_dictionary.decode(self._packed_moveset)
+        return self._moveset
+
+    def opponent_of(self, player_id: str) -> str:
+        return self.white_player_id if self.white_player_id != player_id else self.black_player_id
+
+    def to_dict(self) -> dict:
+        return {
+            'game_id': self.game_id,
+            'moveset': self.moveset,
+            'winner': self.winner,
+            'victory_status': self.victory_status,
+            'number_of_turns': self.number_of_turns,
+            'white_player_id': self.white_player_id,
+            'black_player_id': self.black_player_id,
+            'opening_eco': self.opening_eco
+        }
+
+def queue_store_game(pipe, move_dictionary: MoveDictionary, game_id: str, moveset: list, winner: str, victory_status: str, number_of_turns: int, white_player_id: str, black_player_id: str, opening_eco: str) -> None:
+    """Queue the write of a game record whose moves have been interned on `pipe`.
+    """
+    pipe.hset(f'game:{game_id}', mapping={
+        'moves': move_dictionary.encode(moveset),
+        'winner': winner,
+        'victory_status': victory_status,
+        'number_of_turns': number_of_turns,
+        'white_player_id': white_player_id,
+        'black_player_id': black_player_id,
+        'opening_eco': opening_eco,
+        'check_count': sum('+' in move for move in moveset)
+    })
+
+def get_games(r, move_dictionary: MoveDictionary, game_ids: list) -> list:
+    """Fetch many game records in one pipelined round trip; missing games come back as None.
+    """
+    pipe = r.pipeline(transaction=False)
+    pipe.get(MOVE_GENERATION_KEY)
+    for game_id in game_ids:
+        pipe.hgetall(f'game:{game_id}')
+    generation, *results = pipe.execute()
+    move_dictionary.check_generation(generation)
+    return [GameRecord(game_id, fields, move_dictionary) if fields else None for game_id, fields in zip(game_ids, results)]
+
+def scan_game_ids(r, batch_size: int = 500):
+    """Yield the ids of all stored games in batches of up to `batch_size`.
+    """
+    batch = []
+    for key in r.scan_iter(match='game:*', count=batch_size):
+        # Skip per-game keys such as game:{id}:analytics:check_count from older layouts
+        if key.count(':') == 1:
+            batch.append(key.split(':', 1)[1])
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def migrate_games(r, move_dictionary: MoveDictionary, batch_size: int = 500) -> int:
+    """Convert game records stored as a JSON string in a set to the compact hash layout.
+    Returns the number of games converted.
+    """
+    return sum(_migrate_batch(r, move_dictionary, [f'game:{game_id}' for game_id in game_ids]) for game_ids in scan_game_ids(r, batch_size))
+
+def _migrate_batch(r, move_dictionary: MoveDictionary, keys: list) -> int:
+    pipe = r.pipeline(transaction=False)
+    for key in keys:
+        pipe.type(key)
+    keys = [key for key, key_type in zip(keys, pipe.execute()) if key_type == 'set']
+    pipe = r.pipeline(transaction=False)
+    for key in keys:
+        pipe.smembers(key)
+    records = [json.loads(next(iter(members))) for members in pipe.execute()]
+    move_dictionary.intern(move for record in records for move in record['moveset'])
+    pipe = r.pipeline(transaction=True)
+    for key, record in zip(keys, records):
+        pipe.delete(key)
+        queue_store_game(pipe, move_dictionary, key.split(':', 1)[1], **record)
+    pipe.execute()
+    return len(keys)
@@ -0,0 +1,250 @@
+"""
+Streaming ingest of finished games through a Redis Stream.
+
+Producers XADD games to `games:stream`. Workers in the `game_loaders` consumer group read them
+in batches and apply them with RedisChessLoader.add_game_records, by default with the atomic
+ingest script (STREAM_INGEST_SCRIPT), then acknowledge and delete them. A worker that dies leaves its entries pending; the other workers reclaim them with
+XAUTOCLAIM after STREAM_CLAIM_IDLE_MS. Delivery is at least once, and add_game_records skips
+games that are already stored, so each game is counted exactly once. Entries that cannot be
+parsed or applied are moved to `games:stream:dead`.
+
+Acknowledged entries are deleted, so the stream length is the backlog: games not yet applied.
+Producers wait while it is above STREAM_MAX_BACKLOG.
+"""
+from config import Config
+from load_transform import RedisChessLoader, json_deserialize, json_serialize, parse_game_record
+from multiprocessing import Process
+import csv
+import logging
+import os
+import redis
+import socket
+import sys
+import time
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+handler = logging.StreamHandler()
+formatter = logging.Formatter('%(asctime)s — %(levelname)s — %(message)s')
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+
+STREAM_KEY = 'games:stream'
+DEAD_LETTER_KEY = 'games:stream:dead'
+GROUP = 'game_loaders'
+# Entries read per XRANGE when counting the lag on Redis versions that do not report it
+LAG_COUNT_BATCH_SIZE = 1000
+
+def encode_game(record: dict) -> dict:
+    """Stream entry fields of an `add_game_record` record.
+    """
+    return dict(record, moveset=json_serialize(record['moveset']))
+
+def decode_game(fields: dict) -> dict:
+    return dict(fields, moveset=json_deserialize(fields['moveset']), number_of_turns=int(fields['number_of_turns']))
+
+def publish_games(r, records: list, max_backlog: int = Config.STREAM_MAX_BACKLOG, poll_interval: float = 0.5) -> list:
+    """XADD game records to the stream in one round trip, first waiting while the backlog is
+    at `max_backlog` or more. Returns the entry ids.
+    """
+    waited = False
+    while r.xlen(STREAM_KEY) >= max_backlog:
+        if not waited:
+            logger.warning('Game stream backlog is at %d entries, waiting for the workers', max_backlog)
+            waited = True
+        time.sleep(poll_interval)
+    pipe = r.pipeline(transaction=False)
+    for record in records:
+        pipe.xadd(STREAM_KEY, encode_game(record))
+    return pipe.execute()
+
+def ensure_group(r) -> None:
+    """Create the consumer group (and the stream) unless they exist.
+    """
+    try:
+        r.xgroup_create(STREAM_KEY, GROUP, id='0', mkstream=True)
+    except redis.exceptions.ResponseError as e:
+        if 'BUSYGROUP' not in str(e):
+            raise
+
+def group_lag(r, group: dict) -> int:
+    """Number of stream entries not yet delivered to `group`, an XINFO GROUPS entry.
+    Redis 7 reports it as `lag`; otherwise, or when Redis cannot tell, the entries after the
+    group's last delivered id are counted.
+    """
+    if group.get('lag') is not None:
+        return group['lag']
+    lag, start = 0, f"({group['last-delivered-id']}"
+    while True:
+        entries = r.xrange(STREAM_KEY, min=start, count=LAG_COUNT_BATCH_SIZE)
+        lag += len(entries)
+        if len(entries) < LAG_COUNT_BATCH_SIZE:
+            return lag
+        start = f'({entries[-1][0]}'
+
+def stream_metrics(r) -> dict:
+    """Backpressure metrics of the stream and its consumer group.
+    `lag` is the number of entries not yet delivered to any worker, `pending` the number
+    delivered but not yet acknowledged.
+    """
+    pipe = r.pipeline(transaction=False)
+    pipe.xlen(STREAM_KEY)
+    pipe.xlen(DEAD_LETTER_KEY)
+    pipe.xpending(STREAM_KEY, GROUP)
+    pipe.xinfo_groups(STREAM_KEY)
+    pipe.xinfo_consumers(STREAM_KEY, GROUP)
+    length, dead, pending, groups, consumers = pipe.execute()
+    group = next(group for group in groups if group['name'] == GROUP)
+    return {
+        'length': length,
+        'pending': pending['pending'],
+        'lag': group_lag(r, group),
+        'dead_letters': dead,
+        'consumers': {consumer['name']: {'pending': consumer['pending'], 'idle_ms': consumer['idle']} for consumer in consumers}
+    }
+
+def active_workers(r, idle_ms: int = Config.STREAM_CLAIM_IDLE_MS) -> list:
+    """Names of the workers that read the stream within the last `idle_ms` milliseconds.
+    """
+    try:
+        consumers = r.xinfo_consumers(STREAM_KEY, GROUP)
+    except redis.exceptions.ResponseError:
+        # Neither the stream nor the group exist yet
+        return []
+    return [consumer['name'] for consumer in consumers if consumer['idle'] < idle_ms]
+
+class GameStreamWorker:
+    """A consumer in the `game_loaders` group applying the games it reads.
+    """
+    def __init__(self, consumer: str = None, batch_size: int = Config.STREAM_BATCH_SIZE, block_ms: int = Config.STREAM_BLOCK_MS,
+                 claim_idle_ms: int = Config.STREAM_CLAIM_IDLE_MS, scripted: bool = Config.STREAM_INGEST_SCRIPT):
+        # Each batch is one atomic script call when `scripted`, so concurrent workers never
+        # retry on WATCH conflicts
+        self.loader = RedisChessLoader.ingester(scripted=scripted)
+        self.r = self.loader.r
+        self.consumer = consumer or f'{socket.gethostname()}-{os.getpid()}'
+        self.batch_size = batch_size
+        self.block_ms = block_ms
+        self.claim_idle_ms = claim_idle_ms
+        self.applied = self.reclaimed = self.dead = 0
+        # A restarted worker with the same name first resumes the entries it left pending
+        self.resume_pending = True
+        ensure_group(self.r)
+
+    def reclaim(self) -> list:
+        """Take over entries other workers have left pending for longer than `claim_idle_ms`.
+        """
+        result = self.r.xautoclaim(STREAM_KEY, GROUP, self.consumer, self.claim_idle_ms, count=self.batch_size)
+        entries = result[1]
+        self.reclaimed += len(entries)
+        if entries:
+            logger.info('Reclaimed %d pending games', len(entries))
+        return entries
+
+    def read(self) -> list:
+        if self.resume_pending:
+            response = self.r.xreadgroup(GROUP, self.consumer, {STREAM_KEY: '0'}, count=self.batch_size)
+            if response and response[0][1]:
+                return response[0][1]
+            self.resume_pending = False
+        response = self.r.xreadgroup(GROUP, self.consumer, {STREAM_KEY: '>'}, count=self.batch_size, block=self.block_ms)
+        return response[0][1] if response else []
+
+    def process_once(self) -> int:
+        """Apply one batch of reclaimed or new entries. Returns the number of entries handled.
+        """
+        entries = self.reclaim() or self.read()
+        if not entries:
+            return 0
+        records, done, dead = [], [], []
+        for entry_id, fields in entries:
+            # Entries deleted while pending come back without fields
+            if not fields:
+                done.append(entry_id)
+                continue
+            try:
+                records.append((entry_id, decode_game(fields)))
+            except (KeyError, ValueError) as e:
+                logger.error('Could not parse game stream entry %s: %s', entry_id, e)
+                dead.append((entry_id, fields))
+        try:
+            self.applied += self.loader.add_game_records([record for _, record in records])
+            done.extend(entry_id for entry_id, _ in records)
+        except redis.exceptions.ConnectionError:
+            # Leave the batch pending; this or another worker reclaims it
+            raise
+        except Exception:
+            logger.exception('Could not apply a batch of %d games, applying them one by one', len(records))
+            for entry_id, record in records:
+                try:
+                    self.applied += self.loader.add_game_records([record])
+                    done.append(entry_id)
+                except redis.exceptions.ConnectionError:
+                    raise
+                except Exception:
+                    logger.exception('Could not apply game %s', record.get('game_id'))
+                    dead.append((entry_id, encode_game(record)))
+        pipe = self.r.pipeline(transaction=True)
+        for entry_id, fields in dead:
+            pipe.xadd(DEAD_LETTER_KEY, dict(fields, entry_id=entry_id))
+        acknowledged = done + [entry_id for entry_id, _ in dead]
+        pipe.xack(STREAM_KEY, GROUP, *acknowledged)
+        pipe.xdel(STREAM_KEY, *acknowledged)
+        pipe.execute()
+        self.dead += len(dead)
+        return len(entries)
+
+    def run(self) -> None:
+        logger.info('Game stream worker %s started', self.consumer)
+        while True:
+            self.process_once()
+
+def run_worker(consumer: str = None) -> None:
+    try:
+        GameStreamWorker(consumer).run()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+
+def run_workers(processes: int = Config.STREAM_WORKERS) -> None:
+    """Run a pool of `processes` worker processes until interrupted.
+    """
+    workers = [Process(target=run_worker, args=(f'{socket.gethostname()}-{os.getpid()}-{i}',)) for i in range(processes)]
+    for worker in workers:
+        worker.start()
+    try:
+        for worker in workers:
+            worker.join()
+    except (KeyboardInterrupt, SystemExit):
+        for worker in workers:
+            worker.terminate()
+        logger.info('Game stream workers shut down')
+
+def publish_csv(r, path: str, chunk_size: int = Config.INGEST_CHUNK_SIZE) -> int:
+    """Publish every game of a game records CSV to the stream. Returns the number published.
+    """
+    published, chunk = 0, []
+    with open(path, newline='') as csvfile:
+        for row in csv.DictReader(csvfile):
+            chunk.append(parse_game_record(row))
+            if len(chunk) >= chunk_size:
+                published += len(publish_games(r, chunk))
+                chunk = []
+    if chunk:
+        published += len(publish_games(r, chunk))
+    return published
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ['publish']:
+        path = sys.argv[2] if len(sys.argv) > 2 else Config.game_records_path
+        print(f"Published {publish_csv(Config.get_redis_connection(), path)} games from {path}")
+    elif sys.argv[1:] == ['metrics']:
+        r = Config.get_redis_connection()
+        ensure_group(r)
+        metrics = stream_metrics(r)
+        print(f"Backlog: {metrics['length']} (lag {metrics['lag']}, pending {metrics['pending']}), dead letters: {metrics['dead_letters']}")
+        for consumer, stats in metrics['consumers'].items():
+            print(f"Consumer {consumer}: {stats['pending']} pending, idle {stats['idle_ms']} ms")
+    else:
+        logger.info("Starting %d game stream workers. Use ^C to exit.", Config.STREAM_WORKERS)
+        run_workers()
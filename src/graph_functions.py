@@ -1,96 +1,291 @@
-import json
-from collections import deque
+import sys
+import time
+import uuid
+from collections import Counter
 from config import Config  
+from game_store import MoveDictionary, get_games, migrate_games
+from union_find import PARENT_KEY, SIZE_KEY, SIZES_KEY, find_roots, queue_union
+
+def join_path(parents, meeting):
+    """Walk back from the meeting point of a bidirectional BFS to both ends.
+    """
+    path = []
+    player = meeting
+    while player is not None:
+        path.append(player)
+        player = parents[0][player]
+    path.reverse()
+    player = parents[1][meeting]
+    while player is not None:
+        path.append(player)
+        player = parents[1][player]
+    return path
+
+def queue_opponents(pipe, players):
+    """Queue the lookup of every player's opponents.
+    """
+    for player in players:
+        pipe.zrange(f'player:{player}:opponents', 0, -1)
+
+def smaller_side(frontiers):
+    """The side of a bidirectional BFS to expand next: the one with the smaller frontier.
+    """
+    return 0 if len(frontiers[0]) <= len(frontiers[1]) else 1
+
+def expand_level(parents, frontiers, side, opponents):
+    """Add a whole level to one side of a bidirectional BFS from the `opponents` of its frontier.
+    Returns the new frontiers and a player both sides have reached (None if there is none yet).
+    """
+    seen, other = parents[side], parents[1 - side]
+    next_frontier, meeting = [], None
+    for current, current_opponents in zip(frontiers[side], opponents):
+        for opponent in current_opponents:
+            if opponent in seen:
+                continue
+            seen[opponent] = current
+            next_frontier.append(opponent)
+            if meeting is None and opponent in other:
+                meeting = opponent
+    frontiers = (next_frontier, frontiers[1]) if side == 0 else (frontiers[0], next_frontier)
+    return frontiers, meeting
+
+def queue_friends_of_friends(pipe, user_id, direct_opponents):
+    """Queue the union of the direct opponents' opponents, less the user and the direct
+    opponents, on a transaction; the third reply is the result.
+    """
+    union_key = f'tmp:fof:{user_id}:{uuid.uuid4().hex}'
+    pipe.zunionstore(union_key, [f'player:{opponent}:opponents' for opponent in direct_opponents])
+    pipe.zrem(union_key, user_id, *direct_opponents)
+    pipe.zrange(union_key, 0, -1)
+    pipe.delete(union_key)
+
+def queue_hop_games(pipe, path):
+    """Queue the lookup of a game for every consecutive pair of players in `path`.
+    """
+    for player_a, player_b in zip(path, path[1:]):
+        pipe.srandmember(f'player_versus:{player_a}:{player_b}')
+        pipe.srandmember(f'player_versus:{player_b}:{player_a}')
+
+def hop_games(results):
+    """Pick one game per hop from the replies to `queue_hop_games`.
+    """
+    return [results[i] or results[i + 1] for i in range(0, len(results), 2)]
 
 class GraphQueries:
     def __init__(self):
         self.r = Config.get_redis_connection() # This is to initialize Redis connection
+        self.move_dictionary = MoveDictionary(self.r)
     
+    # Returns a dict of the user's opponents and the number of games played against each
+    def get_opponents(self, user_id):
+        return {opponent: int(games) for opponent, games in self.r.zrange(f'player:{user_id}:opponents', 0, -1, withscores=True)}
+
     # Returns a list of friends of friends for a given user
     def get_friends_of_friends(self, user_id):
-        direct_opponents = set()
-        
-        # get all direct opponents from user's games
-        for game_id in self.r.smembers(f'player:{user_id}:games'):
-            game_data = list(self.r.smembers(f'game:{game_id}'))
-            if not game_data:
-                continue
-            game = json.loads(game_data[0])
-            opponent = game['white_player_id'] if game['white_player_id'] != user_id else game['black_player_id']
-            direct_opponents.add(opponent)
-
-        # to get opponents of direct opponents 
-        fof = set()
-        for opponent in direct_opponents:
-            for game_id in self.r.smembers(f'player:{opponent}:games'):
-                game_data = list(self.r.smembers(f'game:{game_id}'))
-                if not game_data:
-                    continue
-                game = json.loads(game_data[0])
-                candidate = game['white_player_id'] if game['white_player_id'] != opponent else game['black_player_id']
-                if candidate != user_id and candidate not in direct_opponents:
-                    fof.add(candidate)
-        return list(fof)
+        direct_opponents = self.r.zrange(f'player:{user_id}:opponents', 0, -1)
+        if not direct_opponents:
+            return []
+
+        # union the opponents of direct opponents server-side, dropping the user and direct opponents
+        pipe = self.r.pipeline(transaction=True)
+        queue_friends_of_friends(pipe, user_id, direct_opponents)
+        return pipe.execute()[2]
     
     #only those with more wins than the user.
     def stronger_foaf(self, user_id):
-        try:
-            user_wins = int(self.r.get(f'leaderboard:wins:{user_id}') or 0)
-        except:
-            user_wins = 0
+        user_wins = int(self.r.zscore('leaderboard:wins', user_id) or 0)
         
         print(f"\nUser: {user_id} has {user_wins} wins")
             
+        candidates = self.get_friends_of_friends(user_id)
+        pipe = self.r.pipeline(transaction=False)
+        for player in candidates:
+            pipe.zscore('leaderboard:wins', player)
         stronger_players = []
-        for player in self.get_friends_of_friends(user_id):
-            try:
-                wins = int(self.r.get(f'leaderboard:wins:{player}') or 0)
-                print(f"{player} has {wins} wins")
-                if wins > user_wins:
-                    stronger_players.append(player)
-            except:
-                continue
+        for player, wins in zip(candidates, pipe.execute()):
+            wins = int(wins or 0)
+            print(f"{player} has {wins} wins")
+            if wins > user_wins:
+                stronger_players.append(player)
         return stronger_players
 
 
     """
     To calculate the size of the largest connected component in the player graph.
-    A connection exists between players if they have played at least one match together and here
-    Breadth-first search  is used .
+    A connection exists between players if they have played at least one match together.
+    Components are maintained incrementally by the loader (see union_find), so this is a single lookup.
     """
     def longest_connected_component(self):
+        largest = self.r.zrevrange(SIZES_KEY, 0, 0, withscores=True)
+        if largest:
+            return int(largest[0][1])
+        # Without any games every player is a component of their own
+        return 1 if self.r.scard('players') else 0
+
+    # Returns the id of the player's connected component (None if they have not played)
+    def get_component(self, user_id):
+        return find_roots(self.r, [user_id])[0]
+
+    # Returns the size of the player's connected component
+    def get_component_size(self, user_id):
+        root = self.get_component(user_id)
+        return int(self.r.hget(SIZE_KEY, root)) if root is not None else 1
+
+    # Returns True if a chain of games connects the two players
+    def are_connected(self, player1_id, player2_id):
+        if player1_id == player2_id:
+            return True
+        root_1, root_2 = find_roots(self.r, [player1_id, player2_id])
+        return root_1 is not None and root_1 == root_2
+
+    # Yields the connected components of the player graph using breadth-first search
+    def _bfs_components(self):
         all_players = {player for player in self.r.smembers('players')}
         visited = set()
-        max_size = 0
 
         for player in all_players:
             if player not in visited:
-                queue = deque([player])
-                component_size = 0
+                visited.add(player)
+                frontier = [player]
+                component = [player]
                 
-                while queue:
-                    current = queue.popleft()
-                    if current not in visited:
-                        visited.add(current)
-                        component_size += 1
-                        
-                        # get all opponents of the curremt player
-                        for game_id in self.r.smembers(f'player:{current}:games'):
-                            game = json.loads(list(self.r.smembers(f'game:{game_id}'))[0])
-                            opponent = game['white_player_id'] if game['white_player_id'] != current else game['black_player_id']
+                # expand a whole BFS level per round trip
+                while frontier:
+                    pipe = self.r.pipeline(transaction=False)
+                    for current in frontier:
+                        pipe.zrange(f'player:{current}:opponents', 0, -1)
+                    next_frontier = []
+                    for opponents in pipe.execute():
+                        for opponent in opponents:
                             if opponent not in visited:
-                                queue.append(opponent)
+                                visited.add(opponent)
+                                next_frontier.append(opponent)
+                    component.extend(next_frontier)
+                    frontier = next_frontier
                 
-                max_size = max(max_size, component_size)
-        return max_size
+                yield component
+
+    """
+    Recomputes the components from scratch with BFS over the opponent index and compares them
+    with the incrementally maintained ones. Returns the number of components checked and the
+    players whose component disagrees.
+    """
+    def verify_components(self, batch_size=500):
+        checked, mismatches = 0, []
+        for component in self._bfs_components():
+            checked += 1
+            roots = []
+            for i in range(0, len(component), batch_size):
+                roots.extend(find_roots(self.r, component[i:i + batch_size]))
+            # Players who have not played are only tracked once they do
+            if roots == [None]:
+                continue
+            size = self.r.hget(SIZE_KEY, roots[0]) if roots[0] is not None else None
+            if len(set(roots)) != 1 or int(size or 0) != len(component):
+                mismatches.extend(component)
+        return {'components': checked, 'mismatches': mismatches}
+
+    """
+    Rebuilds the components from the opponent index, for data loaded before they were maintained
+    at ingest or after `verify_components` reports mismatches.
+    """
+    def rebuild_components(self, batch_size=500):
+        self.r.delete(PARENT_KEY, SIZE_KEY, SIZES_KEY)
+        players = list(self.r.smembers('players'))
+        for i in range(0, len(players), batch_size):
+            batch = players[i:i + batch_size]
+            pipe = self.r.pipeline(transaction=False)
+            for player in batch:
+                pipe.zrange(f'player:{player}:opponents', 0, -1)
+            pipe_unions = self.r.pipeline(transaction=False)
+            for player, opponents in zip(batch, pipe.execute()):
+                for opponent in opponents:
+                    queue_union(pipe_unions, player, opponent)
+            pipe_unions.execute()
+
+    """
+    Finds the shortest chain of opponents between two players with bidirectional BFS over the
+    opponent index, expanding the smaller frontier one whole level per round trip. Gives up
+    (returns None) when the players are not connected, the chain would be longer than
+    `max_depth` games or `time_budget` seconds have passed. Otherwise returns the players along
+    the chain and, for each consecutive pair, one game they played.
+    """
+    def degrees_of_separation(self, player1_id, player2_id, max_depth=6, time_budget=None):
+        if player1_id == player2_id:
+            return {'players': [player1_id], 'games': []}
+        if not self.are_connected(player1_id, player2_id):
+            return None
+        deadline = time.monotonic() + time_budget if time_budget is not None else None
+        parents = ({player1_id: None}, {player2_id: None})
+        frontiers = ([player1_id], [player2_id])
+        depth, meeting = 0, None
+        while meeting is None and frontiers[0] and frontiers[1] and depth < max_depth:
+            if deadline is not None and time.monotonic() > deadline:
+                return None
+            side = smaller_side(frontiers)
+            pipe = self.r.pipeline(transaction=False)
+            queue_opponents(pipe, frontiers[side])
+            frontiers, meeting = expand_level(parents, frontiers, side, pipe.execute())
+            depth += 1
+        if meeting is None:
+            return None
+
+        # pick one game for every hop in a single round trip
+        path = join_path(parents, meeting)
+        pipe = self.r.pipeline(transaction=False)
+        queue_hop_games(pipe, path)
+        return {'players': path, 'games': hop_games(pipe.execute())}
+
+    """
+    Builds the player -> opponents index from the stored game records, for data loaded before
+    the index was maintained at ingest. Each player's index is rebuilt from scratch, so it is
+    safe to run more than once. Games must be in the hash layout (see game_store.migrate_games).
+    """
+    def backfill_opponent_index(self, batch_size=500):
+        players = list(self.r.smembers('players'))
+        for i in range(0, len(players), batch_size):
+            batch = players[i:i + batch_size]
+            pipe = self.r.pipeline(transaction=False)
+            for player in batch:
+                pipe.smembers(f'player:{player}:games')
+            player_games = pipe.execute()
+            game_ids = list({game_id for games in player_games for game_id in games})
+            games = dict(zip(game_ids, get_games(self.r, self.move_dictionary, game_ids)))
+            pipe = self.r.pipeline(transaction=False)
+            for player, game_ids in zip(batch, player_games):
+                opponents = Counter()
+                for game_id in game_ids:
+                    game = games.get(game_id)
+                    if game is None:
+                        continue
+                    opponents[game.opponent_of(player)] += 1
+                pipe.delete(f'player:{player}:opponents')
+                if opponents:
+                    pipe.zadd(f'player:{player}:opponents', opponents)
+            pipe.execute()
     
 if __name__ == "__main__":
-    print("\n=== Test Graph Queries ===")
     gq = GraphQueries()
+    if sys.argv[1:] == ['backfill']:
+        # The backfill reads games as hashes; convert any stored in the old JSON set layout first
+        converted = migrate_games(gq.r, gq.move_dictionary)
+        if converted:
+            print(f"Converted {converted} game records")
+        gq.backfill_opponent_index()
+        gq.rebuild_components()
+        sys.exit(0)
+    if sys.argv[1:] == ['verify']:
+        report = gq.verify_components()
+        print(f"Checked {report['components']} components, {len(report['mismatches'])} mismatched players")
+        sys.exit(1 if report['mismatches'] else 0)
+
+    print("\n=== Test Graph Queries ===")
     
     sample_player = list(gq.r.smembers('players'))[0]  
     
     print(f"\nTesting with player: {sample_player}")
     print("Friends of friends:", gq.get_friends_of_friends(sample_player))
     print("Stronger FoF:", gq.stronger_foaf(sample_player))
-    print("Largest network component:", gq.longest_connected_component())    
\ No newline at end of file
+    print("Largest network component:", gq.longest_connected_component())
+    other_player = list(gq.r.smembers('players'))[-1]
+    print(f"Degrees of separation to {other_player}:", gq.degrees_of_separation(sample_player, other_player))    
\ No newline at end of file
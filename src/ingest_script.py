@@ -0,0 +1,312 @@
+"""
+Server-side ingest of game records.
+
+GAME_RECORDS_SCRIPT applies a batch of game records in one EVALSHA: for each game that is not
+stored yet it interns and packs the moves, makes the same writes as `queue_game_writes`,
+updates the shortest game pointer exactly as RedisChessLoader._apply_game_record does, then
+bumps the data version and records the checkpoint. Scripts run atomically, so concurrent loaders cannot interleave with a batch
+and nothing has to be WATCHed or retried.
+
+Per-game keys are built inside the script, so it needs a single Redis server (not a cluster).
+
+Run `python ingest_script.py verify [game_records.csv]` to load a game records file into the
+staging database once with the script and once without, and compare the two keyspaces.
+"""
+from config import Config
+from expiry_queue import DUE_KEY, PLAYERS_KEY
+from game_store import MAX_MOVES, MOVE_GENERATION_KEY, MOVE_INDEX_KEY, MOVE_SAN_KEY, SEQUENCES_KEY, new_generation
+from match_history import ORDER_KEY, pair_history_key
+from opening_tree import POSTING_DEPTH, TREE_DEPTH
+from query_cache import DATA_VERSION_KEY
+from union_find import PARENT_KEY, SIZE_KEY, SIZES_KEY, registered_script
+import sys
+
+# KEYS: the move index and SAN hashes, the union-find parent, size and sizes keys, the
+# scheduled game due and players keys, the data version, the ranked sequences, the game order
+# counter, the move dictionary generation and optionally the checkpoint hash.
+# ARGV: MAX_MOVES, TREE_DEPTH, POSTING_DEPTH, the checkpoint offset, rows and last id, the
+# generation to give a new move dictionary, then per
+# record its game id, winner, victory status, number of turns, white and black player ids,
+# opening ECO, the players' pair history key, number of moves and moves. Returns the number
+# of games added.
+GAME_RECORDS_SCRIPT = """
+local max_moves, tree_depth, posting_depth = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local indexes = {}
+
+local function utf8(code)
+    if code < 0x80 then
+        return string.char(code)
+    elseif code < 0x800 then
+        return string.char(0xC0 + math.floor(code / 0x40), 0x80 + code % 0x40)
+    end
+    return string.char(0xE0 + math.floor(code / 0x1000), 0x80 + math.floor(code / 0x40) % 0x40, 0x80 + code % 0x40)
+end
+
+-- Index of a move, assigning the next free index to unseen moves; nil once the dictionary is full
+local function intern(move)
+    local index = indexes[move]
+    if index then
+        return index
+    end
+    index = redis.call('HGET', KEYS[1], move)
+    if not index then
+        index = redis.call('HLEN', KEYS[1])
+        if index >= max_moves then
+            return nil
+        end
+        redis.call('HSET', KEYS[1], move, index)
+        redis.call('HSET', KEYS[2], index, move)
+    end
+    indexes[move] = tonumber(index)
+    return indexes[move]
+end
+
+local function find(x)
+    local parent = redis.call('HGET', KEYS[3], x)
+    if not parent then
+        redis.call('HSET', KEYS[3], x, x)
+        redis.call('HSET', KEYS[4], x, 1)
+        redis.call('ZADD', KEYS[5], 1, x)
+        return x
+    end
+    local root = x
+    while parent ~= root do
+        root = parent
+        parent = redis.call('HGET', KEYS[3], root)
+    end
+    while x ~= root do
+        local parent_of_x = redis.call('HGET', KEYS[3], x)
+        redis.call('HSET', KEYS[3], x, root)
+        x = parent_of_x
+    end
+    return root
+end
+
+local function union(x, y)
+    local a = find(x)
+    local b = find(y)
+    if a == b then
+        return
+    end
+    local size_a = tonumber(redis.call('HGET', KEYS[4], a))
+    local size_b = tonumber(redis.call('HGET', KEYS[4], b))
+    if size_a < size_b then
+        a, b = b, a
+    end
+    redis.call('HSET', KEYS[3], b, a)
+    redis.call('HSET', KEYS[4], a, size_a + size_b)
+    redis.call('HDEL', KEYS[4], b)
+    redis.call('ZADD', KEYS[5], size_a + size_b, a)
+    redis.call('ZREM', KEYS[5], b)
+end
+
+local function add_game(game_id, winner, victory_status, number_of_turns, white, black, opening_eco, pair_history, moves)
+    local packed, checks = {}, 0
+    for i, move in ipairs(moves) do
+        packed[i] = utf8(indexes[move])
+        if string.find(move, '+', 1, true) then
+            checks = checks + 1
+        end
+    end
+    redis.call('HSET', 'game:' .. game_id, 'moves', table.concat(packed), 'winner', winner, 'victory_status', victory_status,
+               'number_of_turns', number_of_turns, 'white_player_id', white, 'black_player_id', black, 'opening_eco', opening_eco,
+               'check_count', checks)
+    redis.call('SADD', 'player:' .. white .. ':games', game_id)
+    redis.call('SADD', 'player:' .. black .. ':games', game_id)
+    redis.call('SADD', 'player_versus:' .. white .. ':' .. black, game_id)
+    redis.call('ZINCRBY', 'player:' .. white .. ':opponents', 1, black)
+    redis.call('ZINCRBY', 'player:' .. black .. ':opponents', 1, white)
+    union(white, black)
+    local order = redis.call('INCR', KEYS[10])
+    redis.call('ZADD', 'player:' .. white .. ':history', order, game_id)
+    redis.call('ZADD', 'player:' .. black .. ':history', order, game_id)
+    redis.call('ZADD', pair_history, order, game_id)
+    local result = string.lower(winner)
+    local winning_player, losing_player
+    if result == 'white' then
+        winning_player, losing_player = white, black
+    elseif result == 'black' then
+        winning_player, losing_player = black, white
+    end
+    if winning_player then
+        redis.call('ZINCRBY', 'leaderboard:wins', 1, winning_player)
+        redis.call('ZINCRBY', 'leaderboard:losses', 1, losing_player)
+    end
+    redis.call('ZINCRBY', 'openings', 1, opening_eco)
+    redis.call('ZINCRBY', 'player:' .. white .. ':opening_counts', 1, opening_eco)
+    redis.call('ZINCRBY', 'player:' .. black .. ':opening_counts', 1, opening_eco)
+    redis.call('ZINCRBY', 'openings:' .. result, 1, opening_eco)
+    if winning_player then
+        redis.call('ZINCRBY', 'player:' .. winning_player .. ':opening_wins', 1, opening_eco)
+    end
+    -- Sequences in order of first appearance, with the positions they start at
+    local sequences, positions = {}, {}
+    for i = 1, #moves - 2 do
+        local sequence = moves[i] .. '>' .. moves[i + 1] .. '>' .. moves[i + 2]
+        if not positions[sequence] then
+            positions[sequence] = {}
+            sequences[#sequences + 1] = sequence
+        end
+        table.insert(positions[sequence], i - 1)
+    end
+    for _, sequence in ipairs(sequences) do
+        redis.call('SADD', 'sequence:' .. sequence .. ':games', game_id)
+        redis.call('HSET', 'sequence:' .. sequence .. ':positions', game_id, table.concat(positions[sequence], ','))
+        redis.call('ZINCRBY', KEYS[9], #positions[sequence], sequence)
+        redis.call('ZINCRBY', 'player:' .. white .. ':sequence_counts', #positions[sequence], sequence)
+        redis.call('ZINCRBY', 'player:' .. black .. ':sequence_counts', #positions[sequence], sequence)
+    end
+    local shortest_game_turns = redis.call('GET', 'analytics:shortest_game_turns')
+    if not shortest_game_turns or tonumber(number_of_turns) <= tonumber(shortest_game_turns) then
+        redis.call('SET', 'analytics:shortest_game_turns', number_of_turns)
+        redis.call('SET', 'analytics:shortest_game', game_id)
+    end
+    for depth = 0, math.min(#moves, tree_depth) do
+        local key = 'opening_tree:' .. table.concat(moves, ' ', 1, depth)
+        redis.call('HINCRBY', key, 'games', 1)
+        redis.call('HINCRBY', key, result, 1)
+        if depth < #moves and depth < tree_depth then
+            redis.call('ZINCRBY', key .. ':next', 1, moves[depth + 1])
+        end
+        if depth > 0 and depth <= posting_depth then
+            redis.call('SADD', key .. ':games', game_id)
+        end
+    end
+    redis.call('DEL', 'scheduled_game:' .. game_id)
+    redis.call('SREM', 'scheduled_games', game_id)
+    redis.call('SREM', 'player:' .. white .. ':scheduled_games', game_id)
+    redis.call('SREM', 'player:' .. black .. ':scheduled_games', game_id)
+    redis.call('ZREM', KEYS[6], game_id)
+    redis.call('HDEL', KEYS[7], game_id)
+end
+
+local records, i = {}, 8
+while i <= #ARGV do
+    local record = {moves = {}}
+    for j = 0, 7 do
+        record[j + 1] = ARGV[i + j]
+    end
+    for j = 1, tonumber(ARGV[i + 8]) do
+        record.moves[j] = ARGV[i + 8 + j]
+    end
+    records[#records + 1] = record
+    i = i + 9 + #record.moves
+end
+-- Intern every move before writing any game, so a full dictionary fails the whole batch
+redis.call('SET', KEYS[11], ARGV[7], 'NX')
+for _, record in ipairs(records) do
+    for _, move in ipairs(record.moves) do
+        if not intern(move) then
+            return redis.error_reply('Move dictionary is full, cannot index ' .. move)
+        end
+    end
+end
+local added = 0
+for _, record in ipairs(records) do
+    -- Skip games that are already stored, including repeats within the batch
+    if redis.call('EXISTS', 'game:' .. record[1]) == 0 then
+        add_game(record[1], record[2], record[3], record[4], record[5], record[6], record[7], record[8], record.moves)
+        added = added + 1
+    end
+end
+if added > 0 then
+    redis.call('INCR', KEYS[8])
+end
+if KEYS[12] then
+    redis.call('HSET', KEYS[12], 'offset', ARGV[4], 'rows', ARGV[5], 'last_id', ARGV[6])
+end
+return added
+"""
+
+def apply_game_records(r, records: list, checkpoint: tuple = None) -> int:
+    """Add game records in a single script call and return the number of games added.
+    `checkpoint` is an optional (key, offset, rows, last_id) written with the batch.
+    The script blocks the server while it runs, so keep batches to INGEST_SCRIPT_BATCH_SIZE.
+    """
+    keys = [MOVE_INDEX_KEY, MOVE_SAN_KEY, PARENT_KEY, SIZE_KEY, SIZES_KEY, DUE_KEY, PLAYERS_KEY, DATA_VERSION_KEY, SEQUENCES_KEY, ORDER_KEY, MOVE_GENERATION_KEY]
+    args = [MAX_MOVES, TREE_DEPTH, POSTING_DEPTH]
+    if checkpoint is not None:
+        keys.append(checkpoint[0])
+        args.extend(checkpoint[1:])
+    else:
+        args.extend(['', '', ''])
+    args.append(new_generation())
+    for record in records:
+        args.extend([record['game_id'], record['winner'], record['victory_status'], record['number_of_turns'],
+                     record['white_player_id'], record['black_player_id'], record['opening_eco'],
+                     pair_history_key(record['white_player_id'], record['black_player_id']), len(record['moveset'])])
+        args.extend(record['moveset'])
+    return registered_script(r, GAME_RECORDS_SCRIPT)(keys=keys, args=args, client=r)
+
+def snapshot(r, batch_size: int = 500) -> dict:
+    """Every key of the database with its type and value.
+    """
+    readers = {
+        'string': lambda pipe, key: pipe.get(key),
+        'hash': lambda pipe, key: pipe.hgetall(key),
+        'set': lambda pipe, key: pipe.smembers(key),
+        'zset': lambda pipe, key: pipe.zrange(key, 0, -1, withscores=True),
+        'list': lambda pipe, key: pipe.lrange(key, 0, -1)
+    }
+    keys = list(r.scan_iter(count=batch_size))
+    values = {}
+    for i in range(0, len(keys), batch_size):
+        batch = keys[i:i + batch_size]
+        pipe = r.pipeline(transaction=False)
+        for key in batch:
+            pipe.type(key)
+        types = pipe.execute()
+        pipe = r.pipeline(transaction=False)
+        for key, key_type in zip(batch, types):
+            readers[key_type](pipe, key)
+        for key, key_type, value in zip(batch, types, pipe.execute()):
+            values[key] = (key_type, value)
+    return values
+
+def _unpack_moves(values: dict) -> None:
+    """Replace the packed movesets of a snapshot with their moves and the move dictionary with
+    its moves, as the two loads may number the moves differently.
+    """
+    moves = values.pop(MOVE_SAN_KEY, ('hash', {}))[1]
+    values[MOVE_INDEX_KEY] = ('hash', sorted(values.get(MOVE_INDEX_KEY, ('hash', {}))[1]))
+    for key, (key_type, value) in values.items():
+        if key.startswith('game:') and key_type == 'hash' and 'moves' in value:
+            value['moves'] = [moves[str(ord(char))] for char in value['moves']]
+
+def verify_game_records(path: str) -> list:
+    """Load the game records in `path` into the empty staging database with the script and
+    without it, and return the keys whose type or value differ. The staging database is left
+    empty.
+    """
+    # Imported here as load_transform builds on this module
+    from load_transform import RedisChessLoader
+    r = Config.get_redis_connection(staging=True)
+    if r.dbsize():
+        raise RuntimeError('The staging database must be empty to verify the ingest script')
+    snapshots = []
+    try:
+        for scripted in (False, True):
+            loader = RedisChessLoader(None, None, path, flush=False, staging=True, scripted=scripted)
+            loader.load_game_records(resume=False)
+            snapshots.append(snapshot(r))
+            r.flushdb()
+    finally:
+        r.flushdb()
+    # The data version only has to change with each batch, and the script bumps it per call;
+    # move dictionary generations are random
+    for values in snapshots:
+        values.pop(DATA_VERSION_KEY, None)
+        values.pop(MOVE_GENERATION_KEY, None)
+        _unpack_moves(values)
+    python_load, scripted_load = snapshots
+    return sorted(key for key in python_load.keys() | scripted_load.keys() if python_load.get(key) != scripted_load.get(key))
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] != ['verify']:
+        sys.exit('Usage: python ingest_script.py verify [game_records.csv]')
+    differences = verify_game_records(sys.argv[2] if len(sys.argv) > 2 else Config.game_records_path)
+    for key in differences[:20]:
+        print(f"Differs: {key}")
+    print(f"{len(differences)} keys differ between the scripted and Python loads")
+    sys.exit(1 if differences else 0)
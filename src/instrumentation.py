@@ -0,0 +1,159 @@
+"""
+Round-trip and latency instrumentation for the Redis client.
+
+With REDIS_INSTRUMENT=1 (or Config.REDIS_INSTRUMENT set before the first connection),
+Config builds an InstrumentedRedis. It records every command and every round trip
+(one per command, one per pipeline or MULTI, and one per command a pipeline sends on its own:
+while WATCHing, or to check and load its scripts) in `metrics`. Each record is attributed to the
+public method that issued it: the closest public method of a class in this source tree
+on the call stack, or failing that the closest public function. A round trip made while
+loading a batch of games is therefore attributed to RedisChessLoader.add_game_records,
+not to a helper.
+"""
+import bisect
+import os
+import redis
+import redis.client
+import sys
+import threading
+import time
+
+SOURCE_DIR = os.path.dirname(os.path.abspath(__file__))
+# Upper bounds, in seconds, of the round-trip latency histogram buckets
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+_OWN_FILES = {os.path.abspath(__file__), os.path.join(SOURCE_DIR, 'config.py')}
+# Whether each code object belongs to a public function of this source tree
+_public_code = dict()
+
+def _is_public(code) -> bool:
+    public = _public_code.get(code)
+    if public is None:
+        filename = os.path.abspath(code.co_filename)
+        public = _public_code[code] = (os.path.dirname(filename) == SOURCE_DIR and filename not in _OWN_FILES
+                                       and (code.co_name == '__init__' or not code.co_name.startswith(('_', '<'))))
+    return public
+
+def calling_method() -> str:
+    """Name the public method (or failing that, function) of this source tree that is running.
+    """
+    function = None
+    frame = sys._getframe(2)
+    while frame is not None:
+        if _is_public(frame.f_code):
+            instance = frame.f_locals.get('self')
+            if instance is not None:
+                return f'{type(instance).__name__}.{frame.f_code.co_name}'
+            if function is None:
+                function = f"{frame.f_globals.get('__name__')}.{frame.f_code.co_name}"
+        frame = frame.f_back
+    return function or '<other>'
+
+class MethodStats:
+    def __init__(self):
+        self.commands = 0
+        self.round_trips = 0
+        self.seconds = 0.0
+        # Count of round trips per latency bucket, the last one being +Inf
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+
+class Metrics:
+    """Thread-safe per-method command, round-trip and latency counters.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.methods = dict()
+
+    def record(self, method: str, commands: int, round_trips: int, seconds: float) -> None:
+        with self.lock:
+            stats = self.methods.get(method)
+            if stats is None:
+                stats = self.methods[method] = MethodStats()
+            stats.commands += commands
+            stats.round_trips += round_trips
+            stats.seconds += seconds
+            stats.buckets[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+
+    def reset(self) -> None:
+        with self.lock:
+            self.methods.clear()
+
+    def totals(self) -> dict:
+        with self.lock:
+            return {
+                'commands': sum(stats.commands for stats in self.methods.values()),
+                'round_trips': sum(stats.round_trips for stats in self.methods.values()),
+                'seconds': sum(stats.seconds for stats in self.methods.values())
+            }
+
+    def report(self) -> str:
+        """A table of the methods by round trips, e.g. for printing after a run.
+        """
+        with self.lock:
+            methods = sorted(self.methods.items(), key=lambda item: item[1].round_trips, reverse=True)
+            lines = [f"{'method':<52}{'round trips':>13}{'commands':>12}{'seconds':>10}{'ms/trip':>9}"]
+            for method, stats in methods:
+                lines.append(f"{method:<52}{stats.round_trips:>13,}{stats.commands:>12,}{stats.seconds:>10.3f}"
+                             f"{stats.seconds / stats.round_trips * 1000 if stats.round_trips else 0:>9.3f}")
+            return '\n'.join(lines)
+
+    def prometheus(self) -> str:
+        """The counters in the Prometheus text exposition format.
+        """
+        lines = [
+            '# TYPE redis_commands_total counter',
+            '# TYPE redis_round_trips_total counter',
+            '# TYPE redis_round_trip_seconds histogram'
+        ]
+        with self.lock:
+            for method, stats in sorted(self.methods.items()):
+                label = 'method="' + method.replace('\\', '\\\\').replace('"', '\\"') + '"'
+                lines.append(f'redis_commands_total{{{label}}} {stats.commands}')
+                lines.append(f'redis_round_trips_total{{{label}}} {stats.round_trips}')
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), stats.buckets):
+                    cumulative += count
+                    lines.append(f'redis_round_trip_seconds_bucket{{{label},le="{bound}"}} {cumulative}')
+                lines.append(f'redis_round_trip_seconds_sum{{{label}}} {stats.seconds}')
+                lines.append(f'redis_round_trip_seconds_count{{{label}}} {cumulative}')
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+
+class InstrumentedPipeline(redis.client.Pipeline):
+    # Seconds spent in commands sent on their own during the current execute()
+    immediate_seconds = 0.0
+
+    def immediate_execute_command(self, *args, **options):
+        # WATCH, the reads made while WATCHing, and SCRIPT EXISTS / LOAD before execute()
+        started = time.perf_counter()
+        try:
+            return super().immediate_execute_command(*args, **options)
+        finally:
+            seconds = time.perf_counter() - started
+            self.immediate_seconds += seconds
+            metrics.record(calling_method(), 1, 1, seconds)
+
+    def execute(self, raise_on_error=True):
+        commands = len(self.command_stack)
+        if not commands:
+            return super().execute(raise_on_error)
+        self.immediate_seconds = 0.0
+        started = time.perf_counter()
+        try:
+            return super().execute(raise_on_error)
+        finally:
+            # The script checks were recorded as round trips of their own
+            metrics.record(calling_method(), commands, 1, time.perf_counter() - started - self.immediate_seconds)
+
+class InstrumentedRedis(redis.Redis):
+    """A Redis client that records its commands in `metrics`.
+    """
+    def execute_command(self, *args, **options):
+        started = time.perf_counter()
+        try:
+            return super().execute_command(*args, **options)
+        finally:
+            metrics.record(calling_method(), 1, 1, time.perf_counter() - started)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return InstrumentedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
@@ -1,42 +1,60 @@
 from config import Config
+from query_cache import cached
+
+def queue_player_rank(pipe, player_id):
+    """Queue the reads of a player's score and position on both leaderboards.
+    """
+    pipe.zscore('leaderboard:wins', player_id)
+    pipe.zrevrank('leaderboard:wins', player_id)
+    pipe.zscore('leaderboard:losses', player_id)
+    pipe.zrevrank('leaderboard:losses', player_id)
+
+def player_rank(player_id, results):
+    """Format the replies to `queue_player_rank` as get_player_rank's result.
+    """
+    wins, wins_rank, losses, losses_rank = results
+    return {
+        'player_id': player_id,
+        'wins': int(wins or 0),
+        'wins_rank': wins_rank + 1 if wins_rank is not None else None,
+        'losses': int(losses or 0),
+        'losses_rank': losses_rank + 1 if losses_rank is not None else None
+    }
 
 class LeaderboardFunctions:
-    def __init__(self):
+    def __init__(self, cache=None):
         self.r = Config.get_redis_connection()
+        # Optional QueryCache serving the leaderboards between loads
+        self.cache = cache
     
-    def get_top_players(self, limit=10):
-        top_players = self.r.lrange('leaderboard:top_players', 0, limit-1)
+    @cached
+    def get_top_players(self, limit=10, offset=0):
+        top_players = self.r.zrevrange('leaderboard:wins', offset, offset + limit - 1, withscores=True)
         
         # Format the results as a list of dictionaries
-        result = []
-        for player_id in top_players:
-            wins = int(self.r.get(f'leaderboard:wins:{player_id}') or 0)
-            result.append({
-                'player_id': player_id,
-                'wins': wins
-            })
-        
-        return result
+        return [{'player_id': player_id, 'wins': int(wins)} for player_id, wins in top_players]
 
-    def get_bottom_players(self, limit=10):
-        bottom_players = self.r.lrange('leaderboard:bottom_players', 0, limit-1)
+    @cached
+    def get_bottom_players(self, limit=10, offset=0):
+        bottom_players = self.r.zrevrange('leaderboard:losses', offset, offset + limit - 1, withscores=True)
         
         # Format the results as a list of dictionaries
-        result = []
-        for player_id in bottom_players:
-            losses = int(self.r.get(f'leaderboard:losses:{player_id}') or 0)
-            result.append({
-                'player_id': player_id,
-                'losses': losses
-            })
-        
-        return result
+        return [{'player_id': player_id, 'losses': int(losses)} for player_id, losses in bottom_players]
+
+    @cached
+    def get_player_rank(self, player_id):
+        """
+        Returns a player's wins, losses and 1-based position on both leaderboards (None if unranked)
+        """
+        pipe = self.r.pipeline(transaction=False)
+        queue_player_rank(pipe, player_id)
+        return player_rank(player_id, pipe.execute())
 
 
 if __name__ == "__main__":
     
     leaderboard_functions = LeaderboardFunctions()
-    choice = input("Choose a leaderboard to view: \n 1. Top players \n 2. Bottom players \n")
+    choice = input("Choose a leaderboard to view: \n 1. Top players \n 2. Bottom players \n 3. Player rank \n")
     if choice == '1':
         top_players = leaderboard_functions.get_top_players()
         print("Top players:")
@@ -47,5 +65,8 @@ if __name__ == "__main__":
         print("Bottom players:")
         for player in bottom_players:
             print(f"Player ID: {player['player_id']}, Losses: {player['losses']}")
+    elif choice == '3':
+        player = leaderboard_functions.get_player_rank(input("Enter the player ID: "))
+        print(f"Player ID: {player['player_id']}, Wins: {player['wins']} (rank {player['wins_rank']}), Losses: {player['losses']} (rank {player['losses_rank']})")
     else:
         print("Invalid choice.")
\ No newline at end of file
@@ -1,13 +1,19 @@
-from apscheduler.schedulers.background import BackgroundScheduler
-from apscheduler.executors.pool import ThreadPoolExecutor
 from config import Config
-from datetime import datetime, timedelta
+from expiry_queue import DUE_KEY, PLAYERS_KEY, ExpiryQueue, SCHEDULE_TTL, queue_remove_scheduled_game, queue_schedule_expiry
+from game_store import MOVE_GENERATION_KEY, SEQUENCES_KEY, MoveDictionary, moveset_sequences, new_generation, queue_store_game
+from ingest_script import apply_game_records
+from match_history import ORDER_KEY, queue_match_history
+from opening_tree import queue_opening_tree
+from query_cache import DATA_VERSION_KEY, queue_bump_version
+from union_find import queue_union
 import ast
 import csv
-import heapq
 import json
 import logging
-import math
+import os
+import random
+import redis
+import sys
 import time
 
 logger = logging.getLogger(__name__)
@@ -27,68 +33,274 @@ def json_deserialize(string) -> dict:
     """
     return json.loads(string)
 
+def parse_game_record(row: dict) -> dict:
+    """Convert a game_records.csv row into `add_game_record` keyword arguments.
+    """
+    return {
+        'game_id': row['game_id'],
+        'moveset': ast.literal_eval(row['moveset']),
+        'winner': row['winner'],
+        'victory_status': row['victory_status'],
+        'number_of_turns': int(row['number_of_turns']),
+        'white_player_id': row['white_player_id'],
+        'black_player_id': row['black_player_id'],
+        'opening_eco': row['opening_eco']
+    }
+
+def checkpoint_key(path: str) -> str:
+    return f'ingest:checkpoint:{os.path.abspath(path)}'
+
+def queue_checkpoint(pipe, path: str, offset: int, rows: int, last_id: str) -> None:
+    """Queue the record of how far into `path` loading has got on `pipe`: the byte offset
+    the next row starts at, the number of rows read and the id of the last row.
+    """
+    pipe.hset(checkpoint_key(path), mapping={'offset': offset, 'rows': rows, 'last_id': last_id})
+
+def retry_backoff(attempt: int) -> None:
+    """Wait before retry `attempt` (from 1) of a batch that lost a WATCH race: a random time up
+    to INGEST_RETRY_BACKOFF doubled per retry, so the loaders that collided spread out.
+    """
+    time.sleep(random.uniform(0, Config.INGEST_RETRY_BACKOFF * 2 ** (attempt - 1)))
+
+def queue_game_writes(pipe, move_dictionary: MoveDictionary, sequences: dict, order: int, game_id: str, moveset: list, winner: str, victory_status: str, number_of_turns: int, white_player_id: str, black_player_id: str, opening_eco: str) -> None:
+    """Queue the writes of a game record that do not depend on any other game on `pipe`.
+    These commute, so they can be applied in any order or from several processes; the
+    shortest game analytic is left to the caller, as is taking the game's `order` in the
+    match history from the `games:order` counter.
+    The game's moves must already be interned in `move_dictionary`.
+    """
+    queue_store_game(pipe, move_dictionary, game_id, moveset, winner, victory_status, number_of_turns, white_player_id, black_player_id, opening_eco)
+    queue_match_history(pipe, game_id, white_player_id, black_player_id, order)
+    pipe.sadd(f'player:{white_player_id}:games', game_id)
+    pipe.sadd(f'player:{black_player_id}:games', game_id)
+    pipe.sadd(f'player_versus:{white_player_id}:{black_player_id}', game_id)
+    # Count the games played between the two players in each player's opponent index
+    pipe.zincrby(f'player:{white_player_id}:opponents', 1, black_player_id)
+    pipe.zincrby(f'player:{black_player_id}:opponents', 1, white_player_id)
+    # Merge the two players' connected components
+    queue_union(pipe, white_player_id, black_player_id)
+    winning_player = losing_player = None
+    if winner.lower() == 'white':
+        winning_player = white_player_id
+        losing_player = black_player_id
+    elif winner.lower() == 'black':
+        winning_player = black_player_id
+        losing_player = white_player_id
+    # Update leaderboard status when either white or black wins
+    if winning_player is not None and losing_player is not None:
+        pipe.zincrby('leaderboard:wins', 1, winning_player)
+        pipe.zincrby('leaderboard:losses', 1, losing_player)
+    # Rank the opening by games played, globally and for each player, and record its result
+    pipe.zincrby('openings', 1, opening_eco)
+    pipe.zincrby(f'player:{white_player_id}:opening_counts', 1, opening_eco)
+    pipe.zincrby(f'player:{black_player_id}:opening_counts', 1, opening_eco)
+    pipe.zincrby(f'openings:{winner.lower()}', 1, opening_eco)
+    if winning_player is not None:
+        pipe.zincrby(f'player:{winning_player}:opening_wins', 1, opening_eco)
+    # Index the game under each of its sequences, with the positions it plays them at, and
+    # rank the sequences by times played, globally and for each player
+    for sequence, positions in sequences.items():
+        pipe.sadd(f'sequence:{sequence}:games', game_id)
+        pipe.hset(f'sequence:{sequence}:positions', game_id, ','.join(map(str, positions)))
+        pipe.zincrby(SEQUENCES_KEY, len(positions), sequence)
+        pipe.zincrby(f'player:{white_player_id}:sequence_counts', len(positions), sequence)
+        pipe.zincrby(f'player:{black_player_id}:sequence_counts', len(positions), sequence)
+    # Add the game's opening moves to the opening tree
+    queue_opening_tree(pipe, game_id, moveset, winner)
+    # Remove the game from scheduled games after adding to the records
+    queue_remove_scheduled_game(pipe, game_id, white_player_id, black_player_id)
+
 class RedisChessLoader:
-    def __init__(self, players_path: str, schedule_path: str, game_records_path: str):
+    def __init__(self, players_path: str, schedule_path: str, game_records_path: str, flush: bool = None, staging: bool = False, scripted: bool = Config.INGEST_SCRIPT):
         self.players_path = players_path
         self.schedule_path = schedule_path
         self.game_records_path = game_records_path
+        # A staging loader fills the spare database while readers keep using the serving one,
+        # until `publish` swaps them
+        self.staging = staging
+        # Apply game records with the server-side script instead of WATCH and MULTI
+        self.scripted = scripted
         # Create redis connection
-        self.r = Config.get_redis_connection()
-        # Create and start a scheduler to manage scheduled games.
-        executors = {'default': ThreadPoolExecutor(5)}
-        self.scheduler = BackgroundScheduler(executors=executors)
-        self.scheduler.start()
-        # Confirm before deleting all data
-        confirm = input("This will delete all Redis data. Continue? (y/n): ")
-        if confirm.lower() == 'y':
+        self.r = Config.get_redis_connection(staging=staging)
+        # Local copy of the interned move dictionary used to pack movesets
+        self.move_dictionary = MoveDictionary(self.r)
+        # Confirm before deleting all data, unless the caller already decided. A staging loader
+        # keeps what it has loaded unless asked, so a reload that crashed resumes from its
+        # checkpoints
+        if flush is None:
+            flush = not staging and input("This will delete all Redis data. Continue? (y/n): ").lower() == 'y'
+        if flush:
             self.r.flushdb()
-            # Create a bloom filter for email
-            self.r.execute_command('BF.RESERVE', 'email_filter', 0.01, 20000)
+        # Set once the email filter is known to exist, so add_players checks for it only once
+        self.email_filter_reserved = False
 
+    @classmethod
+    def ingester(cls, staging: bool = False, scripted: bool = Config.INGEST_SCRIPT):
+        """A loader that applies the game records passed to `add_game_records` rather than
+        loading files, for callers such as the stream workers. It never flushes.
+        """
+        return cls(None, None, None, flush=False, staging=staging, scripted=scripted)
+
+    def publish(self) -> None:
+        """Make the data this staging loader loaded the serving data.
+        SWAPDB exchanges the two databases atomically for every connected client, so readers go
+        from the old data to the new with no gap. State only the serving database has is carried
+        over in the same transaction: the game stream with its consumer group, pending entries
+        and dead letters, and the queue of scheduled games to remove (see
+        `_carry_over_schedules`); the match history order counter never moves back. The staged
+        move dictionary always has a generation, so readers drop their copy of the old one. Load
+        checkpoints describe the data they were written with, so the staging ones are kept.
+        Games that stream workers apply to the serving database would be lost in the swap, so
+        publishing refuses while any worker is active; stop them first (a stopped worker stays
+        active for STREAM_CLAIM_IDLE_MS) and restart them afterwards.
+        The old data, now in the staging database, is then freed by the server on a background
+        thread.
+        """
+        if not self.staging:
+            raise ValueError('Only a loader created with staging=True can publish')
+        # Imported here as game_stream builds on this module
+        from game_stream import DEAD_LETTER_KEY, STREAM_KEY, active_workers
+        serving = Config.get_redis_connection()
+        workers = active_workers(serving)
+        if workers:
+            raise RuntimeError(f'Stop the game stream workers before publishing, or the games they apply are lost: {", ".join(workers)}')
+        attempt = 0
+        while True:
+            with serving.pipeline(transaction=True) as pipe:
+                try:
+                    # Any change to what is carried over aborts the swap
+                    pipe.watch(DATA_VERSION_KEY, ORDER_KEY, DUE_KEY, PLAYERS_KEY)
+                    version, order = pipe.mget(DATA_VERSION_KEY, ORDER_KEY)
+                    staging_version, staging_order = self.r.mget(DATA_VERSION_KEY, ORDER_KEY)
+                    write = self.r.pipeline(transaction=False)
+                    # Move the data version past the serving one so every QueryCache drops its entries
+                    write.set(DATA_VERSION_KEY, max(int(version or 0), int(staging_version or 0)) + 1)
+                    if int(order or 0) > int(staging_order or 0):
+                        write.set(ORDER_KEY, order)
+                    # Readers keep a copy of the move dictionary until its generation changes
+                    write.set(MOVE_GENERATION_KEY, new_generation(), nx=True)
+                    self._carry_over_schedules(pipe, write)
+                    # MOVE does nothing when the key already exists in the destination
+                    write.delete(STREAM_KEY, DEAD_LETTER_KEY)
+                    write.execute()
+                    pipe.multi()
+                    for key in (STREAM_KEY, DEAD_LETTER_KEY):
+                        pipe.move(key, Config._REDIS_STAGING_DB)
+                    pipe.swapdb(Config._REDIS_DB, Config._REDIS_STAGING_DB)
+                    pipe.execute()
+                    break
+                except redis.exceptions.WatchError:
+                    attempt += 1
+                    if attempt > Config.INGEST_MAX_RETRIES:
+                        logger.error('The serving data kept changing while publishing, giving up after %d retries', Config.INGEST_MAX_RETRIES)
+                        raise
+                    logger.info('The serving data changed while publishing, retrying')
+            retry_backoff(attempt)
+        logger.info('Swapped the loaded data into database %d', Config._REDIS_DB)
+        self.r.flushdb(asynchronous=True)
+        self.r, self.staging = serving, False
+        self.move_dictionary.r = serving
+
+    def _carry_over_schedules(self, serving, write, batch_size: int = 500) -> None:
+        """Write through `write`, a staging pipeline, the serving database's scheduled games.
+        Their due times win over the ones the reload gave the same games, so publishing does not
+        postpone removals, and games scheduled since the schedules file was written are kept.
+        Games whose records were loaded are no longer scheduled and are skipped.
+        The queue is read and written `batch_size` games at a time.
+        """
+        batch = []
+        for entry in serving.zscan_iter(DUE_KEY, count=batch_size):
+            batch.append(entry)
+            if len(batch) >= batch_size:
+                self._carry_over_batch(serving, write, batch)
+                batch = []
+        if batch:
+            self._carry_over_batch(serving, write, batch)
+
+    def _carry_over_batch(self, serving, write, due: list) -> None:
+        players = serving.hmget(PLAYERS_KEY, [game_id for game_id, _ in due])
+        read = self.r.pipeline(transaction=False)
+        for game_id, _ in due:
+            read.exists(f'game:{game_id}')
+        for (game_id, due_at), game_players, played in zip(due, players, read.execute()):
+            if played or game_players is None:
+                continue
+            player_1, player_2 = json_deserialize(game_players)
+            write.set(f'scheduled_game:{game_id}', game_players)
+            write.expireat(f'scheduled_game:{game_id}', int(due_at) + 1)
+            write.sadd('scheduled_games', game_id)
+            write.sadd(f'player:{player_1}:scheduled_games', game_id)
+            write.sadd(f'player:{player_2}:scheduled_games', game_id)
+            queue_schedule_expiry(write, game_id, player_1, player_2, due_at)
+        write.execute()
 
     def add_player(self, user_id: str, email: str) -> None:
         """Add player to the Redis database.
         """
         logger.info('Adding player %s', user_id)
-        self.r.set(f'player:{user_id}', email)
-        # Add email to the email-bloom-filter
-        self.r.execute_command('BF.ADD', 'email_filter', email)
-        self.r.set(f'email_user:{email}', user_id)
-        self.r.sadd('players', user_id)
+        self.add_players([(user_id, email)])
+
+    def add_players(self, players: list, checkpoint: tuple = None) -> None:
+        """Add a batch of (user_id, email) players using a single pipeline.
+        `checkpoint` is an optional (path, offset, rows, last_id) to record with the batch.
+        """
+        if not players:
+            return
+        # BF.MADD would otherwise create a default filter far too small for the players
+        if not self.email_filter_reserved:
+            self.reserve_email_filter(self.r.scard('players') + len(players))
+        pipe = self.r.pipeline(transaction=False)
+        for user_id, email in players:
+            pipe.set(f'player:{user_id}', email)
+            pipe.set(f'email_user:{email}', user_id)
+        # Add all emails to the email-bloom-filter at once
+        pipe.execute_command('BF.MADD', 'email_filter', *[email for _, email in players])
+        pipe.sadd('players', *[user_id for user_id, _ in players])
+        if checkpoint is not None:
+            queue_checkpoint(pipe, *checkpoint)
+        pipe.execute()
 
     def remove_scheduled_game(self, game_id: str, player_1: str, player_2: str) -> None:
         """Remove scheduled game from the Redis database.
         """
-        self.r.delete(f'scheduled_game:{game_id}')
-        self.r.srem("scheduled_games", game_id)
-        self.r.srem(f'player:{player_1}:scheduled_games', game_id)
-        self.r.srem(f'player:{player_2}:scheduled_games', game_id)
+        pipe = self.r.pipeline(transaction=False)
+        queue_remove_scheduled_game(pipe, game_id, player_1, player_2)
+        pipe.execute()
 
     def add_schedule(self, game_id: str, player_1: str, player_2: str) -> None:
         """Add scheduled game to the Redis database.
         """
         logger.info('Adding schedule %s', game_id)
-        self.r.set(f'scheduled_game:{game_id}', json_serialize([player_1, player_2]))
-        self.r.sadd('scheduled_games', game_id)
-        self.r.sadd(f'player:{player_1}:scheduled_games', game_id)
-        self.r.sadd(f'player:{player_2}:scheduled_games', game_id)
-        # Set an expiry timer for the scehduled game
-        self.r.expire(f"scheduled_game:{game_id}", 72 * 3600)
-        # Add job to update all data relevant to the scheduled_game after 72 hours
-        self.scheduler.add_job(
-            self.remove_scheduled_game,
-            trigger='date',
-            run_date=datetime.now() + timedelta(hours=72),
-            args=[game_id, player_1, player_2],
-            id=f"remove_{game_id}"
-        )
+        self.add_schedules([(game_id, player_1, player_2)])
         logger.info("Scheduled removal of game %s for players %s and %s", game_id, player_1, player_2)
 
+    def add_schedules(self, schedules: list, checkpoint: tuple = None) -> None:
+        """Add a batch of (game_id, player_1, player_2) scheduled games using a single pipeline.
+        `checkpoint` is an optional (path, offset, rows, last_id) to record with the batch.
+        """
+        if not schedules:
+            return
+        pipe = self.r.pipeline(transaction=False)
+        due = time.time() + SCHEDULE_TTL
+        for game_id, player_1, player_2 in schedules:
+            pipe.set(f'scheduled_game:{game_id}', json_serialize([player_1, player_2]))
+            pipe.sadd(f'player:{player_1}:scheduled_games', game_id)
+            pipe.sadd(f'player:{player_2}:scheduled_games', game_id)
+            # Set an expiry timer for the scehduled game
+            pipe.expire(f"scheduled_game:{game_id}", SCHEDULE_TTL)
+            # Queue the update of all data relevant to the scheduled_game after 72 hours
+            queue_schedule_expiry(pipe, game_id, player_1, player_2, due)
+        pipe.sadd('scheduled_games', *[game_id for game_id, _, _ in schedules])
+        if checkpoint is not None:
+            queue_checkpoint(pipe, *checkpoint)
+        pipe.execute()
+
     def add_game_record(self, game_id: str, moveset: list, winner: str, victory_status: str, number_of_turns: str, white_player_id: str, black_player_id: str, opening_eco: str) -> None:
         """Add game record to the Redis database.
         """
         logger.info('Adding game record %s', game_id)
-        self.r.sadd(f'game:{game_id}', json_serialize({
+        self.add_game_records([{
+            'game_id': game_id,
             'moveset': moveset,
             'winner': winner,
             'victory_status': victory_status,
@@ -96,166 +308,240 @@ class RedisChessLoader:
             'white_player_id': white_player_id,
             'black_player_id': black_player_id,
             'opening_eco': opening_eco
-        }))
-        self.r.sadd(f'player:{white_player_id}:games', game_id)
-        self.r.sadd(f'player:{black_player_id}:games', game_id)
-        self.r.sadd(f'player_versus:{white_player_id}:{black_player_id}', game_id)
-        winning_player = losing_player = None
-        if winner.lower() == 'white':
-            winning_player = white_player_id
-            losing_player = black_player_id
-        elif winner.lower() == 'black':
-            winning_player = black_player_id
-            losing_player = white_player_id
-        # Update leaderboard status when either white or black wins
-        if winning_player is not None and losing_player is not None:
-            self.r.incr(f'leaderboard:wins:{winning_player}')
-            self.r.incr(f'leaderboard:losses:{losing_player}')
-            heap = [] # Track the top 10 wins
-            player_in_leaderboard_wins = False
-            for player in self.r.lrange('leaderboard:top_players', 0, -1):
-                wins = int(self.r.get(f'leaderboard:wins:{player}'))
-                if player == winning_player:
-                    player_in_leaderboard_wins = True
-                heapq.heappush(heap, (-wins, player))
-            if not player_in_leaderboard_wins:
-                heapq.heappush(heap, (-int(self.r.get(f'leaderboard:wins:{winning_player}')), winning_player))
-            self.r.delete('leaderboard:top_players')
-            for i in range(min(10, len(heap))):
-                self.r.rpush('leaderboard:top_players', heapq.heappop(heap)[1])
-            heap = [] # Track the top 10 losses
-            player_in_leaderboard_losses = False
-            for player in self.r.lrange(f'leaderboard:bottom_players', 0, -1):
-                losses = int(self.r.get(f'leaderboard:losses:{player}'))
-                if player == losing_player:
-                    player_in_leaderboard_losses = True
-                heapq.heappush(heap, (-losses, player))
-            if not player_in_leaderboard_losses:
-                heapq.heappush(heap, (-int(self.r.get(f'leaderboard:losses:{losing_player}')), losing_player))
-            self.r.delete('leaderboard:bottom_players')
-            for i in range(min(10, len(heap))):
-                self.r.rpush('leaderboard:bottom_players', heapq.heappop(heap)[1])
-        # Add openings to the set of openings of each player and increment their count
-        self.r.sadd(f'player:{white_player_id}:openings', opening_eco)
-        self.r.sadd(f'player:{black_player_id}:openings', opening_eco)
-        self.r.incr(f'player:{white_player_id}:opening:{opening_eco}:count')
-        self.r.incr(f'player:{black_player_id}:opening:{opening_eco}:count')
-        self.r.incr(f'opening:{opening_eco}')
-        # Update the most frequent opening if necessary
-        try:
-            most_frequent_opening = self.r.get(f'analytics:most_frequent_opening')
-            if int(self.r.get(f'opening:{opening_eco}')) >= int(self.r.get(f'opening:{most_frequent_opening}')):
-                self.r.set(f'analytics:most_frequent_opening', opening_eco)
-        except TypeError:
-            self.r.set(f'analytics:most_frequent_opening', opening_eco)
-        count_of_checks = 0 # Track the count of checks in the game
-        sequence_counts = dict() # Track the count of times a sequence was played throughout all games including this
-        for i in range(len(moveset) - 2):
-            sequence = f'{moveset[i]}>{moveset[i+1]}>{moveset[i+2]}'
-            if sequence in sequence_counts:
-                sequence_counts[sequence] += 1
-            else:
+        }])
+
+    def add_game_records(self, records: list, checkpoint: tuple = None) -> int:
+        """Add a batch of game records to the Redis database, skipping games that are already
+        stored (and repeats within the batch), and return the number of games added.
+        Every key the batch reads is WATCHed and prefetched up front and new moves are interned
+        in one call; the records are then applied in order against that local copy, and all
+        writes go out in a single MULTI/EXEC, so the result is the same as calling
+        `add_game_record` once per record. If another client changes a watched key first, the
+        batch is retried after a jittered backoff, so a game is never counted twice; after
+        INGEST_MAX_RETRIES retries the WatchError is raised.
+        `checkpoint` is an optional (path, offset, rows, last_id) committed with the batch.
+        A scripted loader applies the batch with atomic script calls of INGEST_SCRIPT_BATCH_SIZE
+        records instead, with the same result; the checkpoint goes with the last call.
+        """
+        unique, seen = [], set()
+        for record in records:
+            if record['game_id'] not in seen:
+                seen.add(record['game_id'])
+                unique.append(record)
+        if not unique and checkpoint is None:
+            return 0
+        if self.scripted:
+            added, size = 0, Config.INGEST_SCRIPT_BATCH_SIZE
+            for i in range(0, max(len(unique), 1), size):
+                last = i + size >= len(unique)
+                added += apply_game_records(self.r, unique[i:i + size],
+                                            (checkpoint_key(checkpoint[0]), *checkpoint[1:]) if last and checkpoint is not None else None)
+            return added
+        self.move_dictionary.intern(move for record in unique for move in record['moveset'])
+        attempt = 0
+        while True:
+            with self.r.pipeline(transaction=True) as pipe:
                 try:
-                    sequence_counts[sequence] = 1 + int(self.r.get(f'sequence:{sequence}'))
-                except TypeError:
-                    sequence_counts[sequence] = 1
-            # Increment `count_of_checks` if the current move resulted in a check
-            if '+' in moveset[i]:
-                count_of_checks += 1
-        max_count, max_count_sequence = 0, '' # Track the sequence with the maximum count
-        min_count, min_count_sequence = math.inf, '' # Track the sequence with the minimum count
-        for sequence, count in sequence_counts.items():
-            if max_count < count:
-                max_count = count
-                max_count_sequence = sequence
-            if min_count > count:
-                min_count = count
-                min_count_sequence = sequence
-            # Update count of sequence globally and per player
-            self.r.set(f'sequence:{sequence}', count)
-            self.r.sadd(f'sequence:{sequence}:games', game_id)
-            self.r.sadd(f'player:{white_player_id}:sequences', sequence)
-            self.r.sadd(f'player:{black_player_id}:sequences', sequence)
-        # Update the most common sequence if necessary
-        current_most_common_sequence = self.r.get('analytics:most_common_sequence')
-        try:
-            current_most_common_sequence_count = sequence_counts.get(current_most_common_sequence, int(self.r.get(f'sequence:{current_most_common_sequence}')))
-        except TypeError:
-            current_most_common_sequence_count = 0
-        if max_count >= current_most_common_sequence_count:
-            self.r.set(f'analytics:most_common_sequence', max_count_sequence)
-        # Update the least common sequence if necessary
-        current_least_common_sequence = self.r.get('analytics:least_common_sequence')
-        try:
-            current_least_common_sequence_count = sequence_counts.get(current_least_common_sequence, int(self.r.get(f'sequence:{current_least_common_sequence}')))
-        except TypeError:
-            current_least_common_sequence_count = math.inf
-        if min_count <= current_least_common_sequence_count:
-            self.r.set(f'analytics:least_common_sequence', min_count_sequence)
-        # Check for checks in the last 2 moves as they are not considered in the loop for sequences
-        for move in moveset[-2:]:
-            if '+' in move:
-                count_of_checks += 1
-        # Set the count of checks for the game
-        self.r.set(f'game:{game_id}:analytics:check_count', count_of_checks)
+                    new_records, counters = self._prefetch_counters(pipe, unique)
+                    # Reserve the games' orders in the match history, as the parallel loader
+                    # does; a retry leaves a gap, which does not change the order of the games
+                    if new_records:
+                        counters[ORDER_KEY] = self.r.incrby(ORDER_KEY, len(new_records)) - len(new_records)
+                    pipe.multi()
+                    for record in new_records:
+                        self._apply_game_record(pipe, counters, **record)
+                    if new_records:
+                        queue_bump_version(pipe)
+                    if checkpoint is not None:
+                        queue_checkpoint(pipe, *checkpoint)
+                    pipe.execute()
+                    return len(new_records)
+                except redis.exceptions.WatchError:
+                    attempt += 1
+                    if attempt > Config.INGEST_MAX_RETRIES:
+                        logger.error('Keys of a batch of game records kept changing while loading it, giving up after %d retries', Config.INGEST_MAX_RETRIES)
+                        raise
+                    logger.info('Keys of a batch of game records changed while loading it, retrying')
+            retry_backoff(attempt)
+
+    def _prefetch_counters(self, pipe, records: list) -> tuple:
+        """WATCH on `pipe` and read every key `_apply_game_record` needs for `records`.
+        Returns the records whose games are not stored yet and a dict of the counters, stored
+        as ints, or None when missing.
+        """
+        game_keys = [f'game:{record["game_id"]}' for record in records]
+        # Watch before reading, so a write made after any of these reads aborts the MULTI
+        pipe.watch('analytics:shortest_game_turns', *game_keys)
+        read = self.r.pipeline(transaction=False)
+        read.get('analytics:shortest_game_turns')
+        for key in game_keys:
+            read.exists(key)
+        results = read.execute()
+        shortest_game_turns, stored = results[0], results[1:]
+        counters = {
+            'analytics:shortest_game_turns': int(shortest_game_turns) if shortest_game_turns is not None else None
+        }
+        return [record for record, exists in zip(records, stored) if not exists], counters
+
+    def _apply_game_record(self, pipe, counters: dict, game_id: str, moveset: list, winner: str, victory_status: str, number_of_turns: int, white_player_id: str, black_player_id: str, opening_eco: str) -> None:
+        """Queue the writes for one game record on `pipe`, reading and updating `counters`
+        in place of Redis so later records in the same batch see this record's effects.
+        """
+        sequences = moveset_sequences(moveset)
+        # Orders were reserved for the batch in add_game_records
+        counters[ORDER_KEY] += 1
+        queue_game_writes(pipe, self.move_dictionary, sequences, counters[ORDER_KEY], game_id, moveset, winner, victory_status, number_of_turns, white_player_id, black_player_id, opening_eco)
         # Update the game with the shortest turns if necessary
-        if not self.r.exists('analytics:shortest_game_turns') or number_of_turns <= int(self.r.get('analytics:shortest_game_turns')):
-            self.r.set('analytics:shortest_game_turns', number_of_turns)
-            self.r.set('analytics:shortest_game', game_id)
-        # Remove the game from scheduled games after adding to the records
-        self.remove_scheduled_game(game_id, white_player_id, black_player_id)
-
-    def load_players(self) -> None:
-        """Load players into Redis
+        shortest_game_turns = counters['analytics:shortest_game_turns']
+        if shortest_game_turns is None or number_of_turns <= shortest_game_turns:
+            pipe.set('analytics:shortest_game_turns', number_of_turns)
+            pipe.set('analytics:shortest_game', game_id)
+            counters['analytics:shortest_game_turns'] = number_of_turns
+
+    def _read_chunks(self, path: str, chunk_size: int, offset: int = None):
+        """Stream a CSV file as (rows, offset) for lists of at most `chunk_size` rows, where
+        `offset` is the byte offset the row after the chunk starts at. Reading starts at
+        `offset` if given (one of those offsets), or else at the first row.
+        """
+        with open(path, 'rb') as csvfile:
+            fieldnames = next(csv.reader([csvfile.readline().decode('utf-8')]))
+            if offset:
+                csvfile.seek(offset)
+            chunk = []
+            for line in iter(csvfile.readline, b''):
+                if not line.strip():
+                    continue
+                chunk.append(dict(zip(fieldnames, next(csv.reader([line.decode('utf-8')])))))
+                if len(chunk) >= chunk_size:
+                    yield chunk, csvfile.tell()
+                    chunk = []
+            if chunk:
+                yield chunk, csvfile.tell()
+
+    def get_checkpoint(self, path: str) -> dict:
+        """How far into `path` a previous load got, or None if it has not been loaded.
+        """
+        checkpoint = self.r.hgetall(checkpoint_key(path))
+        if not checkpoint:
+            return None
+        return {'offset': int(checkpoint['offset']), 'rows': int(checkpoint['rows']), 'last_id': checkpoint['last_id']}
+
+    def reset_checkpoint(self, path: str) -> None:
+        """Make the next load of `path` start from its first row.
+        """
+        self.r.delete(checkpoint_key(path))
+
+    def _resume_point(self, path: str, label: str, resume: bool) -> tuple:
+        """Return the (offset, rows) to continue loading `path` from.
+        """
+        checkpoint = self.get_checkpoint(path) if resume else None
+        if checkpoint is None:
+            return None, 0
+        logger.info('Resuming %s after %d rows (last id %s)', label, checkpoint['rows'], checkpoint['last_id'])
+        return checkpoint['offset'], checkpoint['rows']
+
+    def _log_progress(self, label: str, rows: int, started: float) -> None:
+        """Log the number of rows loaded so far and the ingest rate.
+        """
+        elapsed = time.perf_counter() - started
+        logger.info('Loaded %d %s (%.0f rows/sec)', rows, label, rows / elapsed if elapsed > 0 else 0)
+
+    def reserve_email_filter(self, expected_players: int) -> None:
+        """Create the email bloom filter sized for `expected_players`, unless it already exists.
+        The filter is reserved with headroom for growth and scales by adding sub-filters
+        (EXPANSION) once full, so the false-positive rate holds as players are added.
+        """
+        if not self.r.exists('email_filter'):
+            capacity = max(1000, int(expected_players * Config.EMAIL_FILTER_HEADROOM))
+            logger.info('Reserving email filter for %d players', capacity)
+            try:
+                self.r.execute_command('BF.RESERVE', 'email_filter', Config.EMAIL_FILTER_ERROR_RATE, capacity,
+                                       'EXPANSION', Config.EMAIL_FILTER_EXPANSION)
+            except redis.exceptions.ResponseError as e:
+                # Another loader reserved it first
+                if 'exists' not in str(e):
+                    raise
+        self.email_filter_reserved = True
+
+    def load_players(self, chunk_size: int = Config.INGEST_CHUNK_SIZE, resume: bool = True) -> None:
+        """Load players into Redis, continuing from the last checkpoint when `resume` is set
         """
         logger.info('Loading players...')
-        with open(self.players_path, newline='') as csvfile:
-            reader = csv.DictReader(csvfile)
-            for row in reader:
-                self.add_player(row['user_id'], row['email'])
+        # Size the email filter from the number of rows to load
+        with open(self.players_path, 'rb') as csvfile:
+            self.reserve_email_filter(self.r.scard('players') + sum(1 for _ in csvfile) - 1)
+        offset, rows = self._resume_point(self.players_path, 'players', resume)
+        started, loaded = time.perf_counter(), 0
+        for chunk, offset in self._read_chunks(self.players_path, chunk_size, offset):
+            rows += len(chunk)
+            self.add_players([(row['user_id'], row['email']) for row in chunk],
+                             checkpoint=(self.players_path, offset, rows, chunk[-1]['user_id']))
+            loaded += len(chunk)
+            self._log_progress('players', loaded, started)
 
-    def load_schedules(self) -> None:
-        """Load schedules into Redis
+    def load_schedules(self, chunk_size: int = Config.INGEST_CHUNK_SIZE, resume: bool = True) -> None:
+        """Load schedules into Redis, continuing from the last checkpoint when `resume` is set
         """
         logger.info('Loading schedules...')
-        with open(self.schedule_path, newline='') as csvfile:
-            reader = csv.DictReader(csvfile)
-            for row in reader:
-                self.add_schedule(row['game_id'], row['player_1'], row['player_2'])
+        offset, rows = self._resume_point(self.schedule_path, 'schedules', resume)
+        started, loaded = time.perf_counter(), 0
+        for chunk, offset in self._read_chunks(self.schedule_path, chunk_size, offset):
+            rows += len(chunk)
+            self.add_schedules([(row['game_id'], row['player_1'], row['player_2']) for row in chunk],
+                               checkpoint=(self.schedule_path, offset, rows, chunk[-1]['game_id']))
+            loaded += len(chunk)
+            self._log_progress('schedules', loaded, started)
 
-    def load_game_records(self) -> None:
-        """Load game records into Redis"""
+    def load_game_records(self, chunk_size: int = Config.INGEST_CHUNK_SIZE, resume: bool = True) -> None:
+        """Load game records into Redis, continuing from the last checkpoint when `resume` is set.
+        Games that are already stored are skipped either way, so a load can be repeated safely.
+        """
         logger.info('Loading game records...')
-        with open(self.game_records_path, newline='') as csvfile:
-            reader = csv.DictReader(csvfile)
-            for row in reader:
-                self.add_game_record(
-                    game_id = row['game_id'],
-                    moveset = ast.literal_eval(row['moveset']),
-                    winner = row['winner'],
-                    victory_status = row['victory_status'],
-                    number_of_turns = int(row['number_of_turns']),
-                    white_player_id = row['white_player_id'],
-                    black_player_id = row['black_player_id'],
-                    opening_eco = row['opening_eco']
-                )
+        offset, rows = self._resume_point(self.game_records_path, 'game records', resume)
+        started, loaded, skipped = time.perf_counter(), 0, 0
+        for chunk, offset in self._read_chunks(self.game_records_path, chunk_size, offset):
+            rows += len(chunk)
+            records = [parse_game_record(row) for row in chunk]
+            added = self.add_game_records(records, checkpoint=(self.game_records_path, offset, rows, records[-1]['game_id']))
+            skipped += len(records) - added
+            loaded += len(chunk)
+            self._log_progress('game records', loaded, started)
+        if skipped:
+            logger.info('Skipped %d game records that were already loaded', skipped)
+
+    def load_game_records_parallel(self, processes: int = Config.INGEST_PROCESSES, chunk_size: int = Config.INGEST_CHUNK_SIZE, resume: bool = True) -> None:
+        """Load game records into Redis from byte-range shards parsed by a process pool,
+        continuing each shard from its checkpoint when `resume` is set.
+        The global analytics come out the same as with `load_game_records`.
+        """
+        # Imported here as parallel_loader builds on this module's helpers
+        from parallel_loader import load_game_records_parallel
+        load_game_records_parallel(self.r, self.game_records_path, processes, chunk_size, staging=self.staging, resume=resume)
 
 
 if __name__ == "__main__":
+    # `reload` loads into the staging database without prompting, resuming a reload that
+    # stopped early, and swaps it in when done; `reload fresh` clears the staging database first
+    reload = sys.argv[1:2] == ['reload']
     loader = RedisChessLoader(
         players_path = Config.players_path,
         schedule_path = Config.schedule_path,
-        game_records_path = Config.game_records_path
+        game_records_path = Config.game_records_path,
+        flush = sys.argv[2:] == ['fresh'] if reload else None,
+        staging = reload
     )
     logger.info("\nData loading...")
     loader.load_players()
     loader.load_schedules()
-    loader.load_game_records()
+    if Config.INGEST_PROCESSES > 1:
+        loader.load_game_records_parallel()
+    else:
+        loader.load_game_records()
+    if reload:
+        loader.publish()
     logger.info("\nData loading complete!")
-    logger.info("The loader will remain alive to manage scheduled games. Use ^C to exit (WARNING: Scheduled games will not be managed upon exit).")
+    logger.info("The loader will remain alive to sweep scheduled games. Use ^C to exit (scheduled games stay queued in Redis and are removed by the next sweeper).")
     try:
-        while True:
-            time.sleep(1)
+        ExpiryQueue(loader.r).run()
     except (KeyboardInterrupt, SystemExit):
-        loader.scheduler.shutdown()
-        logger.info("Scheduler shut down")
+        logger.info("Sweeper shut down")
@@ -0,0 +1,88 @@
+"""
+Time-ordered match history indexes.
+
+Every game gets the next value of the `games:order` counter when it is added, and is indexed
+under it in `player:{id}:history` for both of its players and in
+`player_pair:{a}:{b}:history` for the pair (the two ids in sorted order, so a pair has one
+index whichever colour each played). HISTORY_SCRIPT pages through an index from newest to
+oldest, reading each game's hash server-side to apply the filters, so only the page is sent
+back. A call examines at most HISTORY_SCAN_LIMIT games, so a rare filter cannot keep the
+script running over a whole index: the page may then come back short, or empty, with the
+cursor at the last game examined. The cursor is the order to continue below, and 0 when
+there are no more games.
+"""
+
+ORDER_KEY = 'games:order'
+COLOURS = ('white', 'black')
+RESULTS = ('win', 'loss', 'draw')
+# Games read from the index per ZREVRANGEBYSCORE while filling a page
+HISTORY_SCAN_SIZE = 100
+# Games examined per HISTORY_SCRIPT call before it returns a short page
+HISTORY_SCAN_LIMIT = 1000
+
+# KEYS: the history index. ARGV: the player whose view the filters take, the highest order to
+# return ('+inf' or an exclusive '(order'), the page size, the colour, result, victory status
+# and opening to match ('' matches anything), HISTORY_SCAN_SIZE and HISTORY_SCAN_LIMIT.
+# Returns the page of game ids and the cursor.
+HISTORY_SCRIPT = """
+local player, max, count = ARGV[1], ARGV[2], tonumber(ARGV[3])
+local colour, result, victory_status, opening = ARGV[4], ARGV[5], ARGV[6], ARGV[7]
+local scan_size, remaining = tonumber(ARGV[8]), tonumber(ARGV[9])
+local page, order = {}, nil
+while remaining > 0 do
+    local batch = redis.call('ZREVRANGEBYSCORE', KEYS[1], max, '-inf', 'WITHSCORES', 'LIMIT', 0, math.min(scan_size, remaining))
+    if #batch == 0 then
+        return {page, 0}
+    end
+    for i = 1, #batch, 2 do
+        local game_id = batch[i]
+        order = batch[i + 1]
+        remaining = remaining - 1
+        local game = redis.call('HMGET', 'game:' .. game_id, 'white_player_id', 'winner', 'victory_status', 'opening_eco')
+        local game_colour = game[1] == player and 'white' or 'black'
+        local winner = string.lower(game[2] or '')
+        local game_result = winner == 'draw' and 'draw' or (winner == game_colour and 'win' or 'loss')
+        if (colour == '' or colour == game_colour) and (result == '' or result == game_result)
+                and (victory_status == '' or victory_status == game[3]) and (opening == '' or opening == game[4]) then
+            page[#page + 1] = game_id
+            if #page == count then
+                return {page, order}
+            end
+        end
+        max = '(' .. order
+    end
+end
+-- Out of games to examine; continue below the last one
+return {page, order}
+"""
+
+def player_history_key(player_id: str) -> str:
+    return f'player:{player_id}:history'
+
+def pair_history_key(player_1: str, player_2: str) -> str:
+    return 'player_pair:{}:{}:history'.format(*sorted((player_1, player_2)))
+
+def history_page(reply: list) -> dict:
+    """Format a HISTORY_SCRIPT reply as a page of match history.
+    """
+    games, cursor = reply
+    return {'games': games, 'cursor': int(cursor)}
+
+def queue_match_history(pipe, game_id: str, white_player_id: str, black_player_id: str, order: int) -> None:
+    """Queue the indexing of a game added as number `order` on `pipe`.
+    """
+    pipe.zadd(player_history_key(white_player_id), {game_id: order})
+    pipe.zadd(player_history_key(black_player_id), {game_id: order})
+    pipe.zadd(pair_history_key(white_player_id, black_player_id), {game_id: order})
+
+def history_args(player_id: str, cursor: int, count: int, colour: str, result: str, victory_status: str, opening: str) -> list:
+    """HISTORY_SCRIPT arguments for a page of `player_id`'s view of an index.
+    """
+    if colour is not None and colour not in COLOURS:
+        raise ValueError(f'colour must be one of {COLOURS}')
+    if result is not None and result not in RESULTS:
+        raise ValueError(f'result must be one of {RESULTS}')
+    if count < 1:
+        raise ValueError('count must be at least 1')
+    return [player_id, f'({cursor}' if cursor else '+inf', count, colour or '', result or '', victory_status or '', opening or '',
+            HISTORY_SCAN_SIZE, HISTORY_SCAN_LIMIT]
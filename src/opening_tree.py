@@ -0,0 +1,59 @@
+"""
+Move-prefix trie over the opening moves of every game.
+
+The node for a prefix of moves is a hash at `opening_tree:{moves separated by spaces}` (the
+root is `opening_tree:`) counting the games that started with it and their results.
+`{node}:next` ranks the moves played next by number of games, and `{node}:games` lists the
+games of nodes up to POSTING_DEPTH plies deep.
+"""
+
+# Number of plies of each game added to the tree
+TREE_DEPTH = 12
+# Number of plies up to which nodes keep the ids of their games
+POSTING_DEPTH = 6
+
+def node_key(prefix) -> str:
+    return 'opening_tree:' + ' '.join(prefix)
+
+def queue_opening_tree(pipe, game_id: str, moveset: list, winner: str) -> None:
+    """Queue the addition of a game's opening moves to the tree on `pipe`.
+    """
+    result = winner.lower()
+    for depth in range(min(len(moveset), TREE_DEPTH) + 1):
+        key = node_key(moveset[:depth])
+        pipe.hincrby(key, 'games', 1)
+        pipe.hincrby(key, result, 1)
+        if depth < len(moveset) and depth < TREE_DEPTH:
+            pipe.zincrby(f'{key}:next', 1, moveset[depth])
+        if 0 < depth <= POSTING_DEPTH:
+            pipe.sadd(f'{key}:games', game_id)
+
+def node_stats(fields: dict) -> dict:
+    """Format a node hash as game and result counts.
+    """
+    return {
+        'games': int(fields.get('games', 0)),
+        'white': int(fields.get('white', 0)),
+        'black': int(fields.get('black', 0)),
+        'draw': int(fields.get('draw', 0))
+    }
+
+def queue_opening_node(pipe, moves, limit=None) -> None:
+    """Queue the reads of the node for `moves` and its `limit` most played continuations.
+    """
+    key = node_key(moves)
+    pipe.hgetall(key)
+    pipe.zrevrange(f'{key}:next', 0, -1 if limit is None else limit - 1)
+
+def queue_continuations(pipe, moves, continuations: list) -> None:
+    """Queue the reads of the nodes one move past `moves`.
+    """
+    for move in continuations:
+        pipe.hgetall(node_key(list(moves) + [move]))
+
+def opening_stats(fields: dict, continuations: list, children: list) -> dict:
+    """Format a node and its continuations' nodes as returned by explore_opening.
+    """
+    stats = node_stats(fields)
+    stats['continuations'] = [dict(move=move, **node_stats(child)) for move, child in zip(continuations, children)]
+    return stats
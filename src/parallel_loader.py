@@ -0,0 +1,186 @@
+from config import Config
+from game_store import MoveDictionary, moveset_sequences
+from load_transform import checkpoint_key, parse_game_record, queue_game_writes, retry_backoff
+from match_history import ORDER_KEY
+from query_cache import queue_bump_version
+from multiprocessing import Pool
+import csv
+import io
+import logging
+import os
+import redis
+import time
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+handler = logging.StreamHandler()
+formatter = logging.Formatter('%(asctime)s — %(levelname)s — %(message)s')
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+
+def split_shards(path: str, shards: int) -> tuple:
+    """Split a CSV file into `shards` byte ranges covering every row after the header.
+    Returns the header fields and a list of (start, end) offsets; each shard owns the rows
+    that start inside its range.
+    """
+    with open(path, 'rb') as csvfile:
+        header = csvfile.readline()
+        data_start = csvfile.tell()
+        size = os.fstat(csvfile.fileno()).st_size
+    fieldnames = next(csv.reader([header.decode('utf-8')]))
+    step = max(1, (size - data_start) // shards)
+    bounds = [data_start + i * step for i in range(shards)] + [size]
+    return fieldnames, [(bounds[i], bounds[i + 1]) for i in range(shards) if bounds[i] < bounds[i + 1]]
+
+def read_shard(path: str, start: int, end: int, fieldnames: list):
+    """Yield (offset, row) for every row starting in [start, end).
+    A row straddling `start` belongs to the previous shard and is skipped.
+    """
+    with open(path, 'rb') as csvfile:
+        csvfile.seek(start - 1)
+        # Move to the first row starting at or after `start`
+        if csvfile.read(1) != b'\n':
+            csvfile.readline()
+        offset = csvfile.tell()
+        while offset < end:
+            line = csvfile.readline()
+            if not line:
+                break
+            if line.strip():
+                values = next(csv.reader(io.StringIO(line.decode('utf-8'))))
+                yield offset, dict(zip(fieldnames, values))
+            offset = csvfile.tell()
+
+def shard_checkpoint_key(path: str, start: int, end: int) -> str:
+    return f'{checkpoint_key(path)}:shard:{start}:{end}'
+
+def load_shard(path: str, start: int, end: int, fieldnames: list, chunk_size: int, staging: bool = False, resume: bool = True) -> dict:
+    """Worker: write the games of one shard that are not stored yet and return the number
+    written and the partial aggregates of every row in the shard, stored before or not.
+    `shortest` is [turns, offset, game_id] of the last shortest game in the shard.
+    Each chunk records a checkpoint of the shard with its writes, holding the aggregates so
+    far, so with `resume` the shard continues after the last chunk a previous load committed.
+    """
+    r = Config.get_redis_connection(staging=staging)
+    move_dictionary = MoveDictionary(r)
+    key = shard_checkpoint_key(path, start, end)
+    shortest, rows, written = None, 0, 0
+    checkpoint = r.hgetall(key) if resume else None
+    if checkpoint:
+        start, rows = int(checkpoint['offset']), int(checkpoint['rows'])
+        shortest = [int(checkpoint['shortest_game_turns']), int(checkpoint['shortest_game_offset']), checkpoint['shortest_game']]
+    chunk = []
+    for offset, row in read_shard(path, start, end, fieldnames):
+        chunk.append((offset, parse_game_record(row)))
+        if len(chunk) >= chunk_size:
+            rows += len(chunk)
+            shortest, added = _load_chunk(r, move_dictionary, chunk, shortest, (key, rows))
+            written += added
+            chunk = []
+    if chunk:
+        rows += len(chunk)
+        shortest, added = _load_chunk(r, move_dictionary, chunk, shortest, (key, rows))
+        written += added
+    return {'rows': written, 'shortest': shortest}
+
+def _load_chunk(r, move_dictionary: MoveDictionary, chunk: list, shortest: list, checkpoint: tuple) -> tuple:
+    """Write the games of a chunk of (offset, record) that are not stored yet in one
+    MULTI/EXEC, together with the shard's `checkpoint` (key, rows read), and fold every record
+    into the shortest game.
+    Returns the updated shortest game and the number of games written.
+    """
+    unique, seen = [], set()
+    for offset, record in chunk:
+        if record['game_id'] not in seen:
+            seen.add(record['game_id'])
+            unique.append((offset, record))
+        # Games stored by an earlier, interrupted load still count, as its aggregates were never applied
+        if shortest is None or record['number_of_turns'] <= shortest[0]:
+            shortest = [record['number_of_turns'], offset, record['game_id']]
+    move_dictionary.intern(move for _, record in unique for move in record['moveset'])
+    attempt = 0
+    while True:
+        with r.pipeline(transaction=True) as pipe:
+            try:
+                game_keys = [f'game:{record["game_id"]}' for _, record in unique]
+                # Another shard storing one of these games first aborts the MULTI
+                pipe.watch(*game_keys)
+                read = r.pipeline(transaction=False)
+                for key in game_keys:
+                    read.exists(key)
+                written = []
+                new_records = [(offset, record) for (offset, record), exists in zip(unique, read.execute()) if not exists]
+                # Reserve the games' orders in the match history; a retry leaves a gap, which
+                # does not change the order of the games
+                order = r.incrby(ORDER_KEY, len(new_records)) - len(new_records) if new_records else 0
+                pipe.multi()
+                for offset, record in new_records:
+                    game_sequences = moveset_sequences(record['moveset'])
+                    order += 1
+                    queue_game_writes(pipe, move_dictionary, game_sequences, order, **record)
+                    written.append((offset, record))
+                if written:
+                    queue_bump_version(pipe)
+                # read_shard resumes after the row starting just before the checkpoint offset
+                pipe.hset(checkpoint[0], mapping={
+                    'offset': chunk[-1][0] + 1, 'rows': checkpoint[1], 'last_id': chunk[-1][1]['game_id'],
+                    'shortest_game_turns': shortest[0], 'shortest_game_offset': shortest[1], 'shortest_game': shortest[2]
+                })
+                pipe.execute()
+                break
+            except redis.exceptions.WatchError:
+                attempt += 1
+                if attempt > Config.INGEST_MAX_RETRIES:
+                    logger.error('Games of the chunk kept being stored by other workers, giving up after %d retries', Config.INGEST_MAX_RETRIES)
+                    raise
+                logger.info('A game of the chunk was stored by another worker, retrying')
+        retry_backoff(attempt)
+    return shortest, len(written)
+
+def _load_shard(args: tuple) -> dict:
+    return load_shard(*args)
+
+def merge_aggregate(total: dict, partial: dict) -> None:
+    """Fold one shard's aggregates into `total`, keeping the latest shortest game.
+    """
+    total['rows'] += partial['rows']
+    shortest = partial['shortest']
+    if shortest is not None and (total['shortest'] is None or (shortest[0], -shortest[1]) <= (total['shortest'][0], -total['shortest'][1])):
+        total['shortest'] = shortest
+
+def apply_aggregate(r, total: dict) -> None:
+    """Set the global analytics from the combined shard aggregates.
+    """
+    shortest_game_turns = r.get('analytics:shortest_game_turns')
+    pipe = r.pipeline(transaction=True)
+    shortest = total['shortest']
+    if shortest is not None and (shortest_game_turns is None or shortest[0] <= int(shortest_game_turns)):
+        pipe.set('analytics:shortest_game_turns', shortest[0])
+        pipe.set('analytics:shortest_game', shortest[2])
+    queue_bump_version(pipe)
+    pipe.execute()
+
+def load_game_records_parallel(r, path: str, processes: int = Config.INGEST_PROCESSES, chunk_size: int = Config.INGEST_CHUNK_SIZE, shards: int = None, staging: bool = False, resume: bool = True) -> None:
+    """Load a game records CSV with a pool of `processes` workers.
+    Workers parse their shard, write the games that are not stored yet, and pre-aggregate the
+    shortest-game statistics over every row; the parent then sets the analytics from those.
+    Repeating a load adds nothing, and with `resume` each shard continues from its checkpoint
+    when split the same way as before.
+    With `staging`, the workers write to the staging database `r` belongs to.
+    """
+    processes = processes or os.cpu_count()
+    # More shards than workers keeps the pool busy when shard sizes are uneven
+    fieldnames, ranges = split_shards(path, shards or processes * 4)
+    logger.info('Loading game records from %d shards with %d processes...', len(ranges), processes)
+    started = time.perf_counter()
+    total = {'rows': 0, 'shortest': None}
+    with Pool(processes) as pool:
+        for partial in pool.imap_unordered(_load_shard, [(path, start, end, fieldnames, chunk_size, staging, resume) for start, end in ranges]):
+            merge_aggregate(total, partial)
+            elapsed = time.perf_counter() - started
+            logger.info('Loaded %d game records (%.0f rows/sec)', total['rows'], total['rows'] / elapsed if elapsed > 0 else 0)
+    apply_aggregate(r, total)
+
+
+if __name__ == "__main__":
+    load_game_records_parallel(Config.get_redis_connection(), Config.game_records_path)
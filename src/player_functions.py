@@ -1,5 +1,8 @@
 from config import Config
+from game_store import scan_game_ids
+from match_history import HISTORY_SCRIPT, ORDER_KEY, history_args, history_page, pair_history_key, player_history_key
 import logging
+import sys
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -8,6 +11,36 @@ formatter = logging.Formatter('%(asctime)s — %(levelname)s — %(message)s')
 handler.setFormatter(formatter)
 logger.addHandler(handler)
 
+def email_candidates(emails, exists):
+    """The emails the email filter may hold, given its BF.MEXISTS replies.
+    """
+    return [email for email, found in zip(emails, exists) if found]
+
+def players_by_email(emails, candidates, user_ids):
+    """Map every email to its user id (None for unknown emails), given the ids of the candidates.
+    """
+    players = dict.fromkeys(emails)
+    players.update(zip(candidates, user_ids))
+    return players
+
+def queue_player_top_openings(pipe, user_id, limit):
+    """Queue the reads of the player's `limit` most played openings and their wins with each.
+    """
+    pipe.zrevrange(f'player:{user_id}:opening_counts', 0, limit - 1, withscores=True)
+    pipe.zrange(f'player:{user_id}:opening_wins', 0, -1, withscores=True)
+
+def player_opening_stats(results):
+    """Format the replies to `queue_player_top_openings` as get_player_top_openings' result.
+    """
+    openings, wins = results
+    wins = dict(wins)
+    return [{
+        'opening': opening,
+        'count': int(count),
+        'wins': int(wins.get(opening, 0)),
+        'win_rate': wins.get(opening, 0) / count
+    } for opening, count in openings]
+
 class PlayerFunctions:
     def __init__(self):
         self.r = Config.get_redis_connection()
@@ -18,44 +51,91 @@ class PlayerFunctions:
     def view_scheduled_games(self, user_id):
         return self.r.smembers(f'player:{user_id}:scheduled_games')
     
+    # Returns the user_id registered with the email, or None
     def find_player_by_email(self, email):  
-        return self.r.execute_command('BF.EXISTS', 'email_filter', email)
+        # The bloom filter has no false negatives, so a miss needs no lookup
+        if not self.r.execute_command('BF.EXISTS', 'email_filter', email):
+            return None
+        return self.r.get(f'email_user:{email}')
+
+    # Returns a dict of email -> user_id (None for unknown emails) in at most two round trips
+    def find_players_by_emails(self, emails):
+        emails = list(emails)
+        if not emails:
+            return {}
+        candidates = email_candidates(emails, self.r.execute_command('BF.MEXISTS', 'email_filter', *emails))
+        user_ids = self.r.mget([f'email_user:{email}' for email in candidates]) if candidates else []
+        return players_by_email(emails, candidates, user_ids)
 
     def get_games_between_players(self, player1_id, player2_id):
-        return self.r.smembers(f'player_versus:{player1_id}:{player2_id}').union(self.r.smembers(f'player_versus:{player2_id}:{player1_id}'))
+        return self.r.sunion(f'player_versus:{player1_id}:{player2_id}', f'player_versus:{player2_id}:{player1_id}')
+
+    """
+    Pages through the player's games, newest first, as {'games': game ids, 'cursor': ...};
+    pass the cursor back for the next page, until it is 0. Games can be filtered on the
+    player's colour ('white' / 'black'), their result ('win' / 'loss' / 'draw'), the
+    victory_status and the opening ECO code. The filters run server-side, so only the page
+    is transferred; each call examines at most HISTORY_SCAN_LIMIT games, so a page of a
+    rarely matching filter can be short, or empty, before the cursor reaches 0.
+    """
+    def get_match_history(self, user_id, cursor=0, count=20, colour=None, result=None, victory_status=None, opening=None):
+        return self._history_page(player_history_key(user_id), history_args(user_id, cursor, count, colour, result, victory_status, opening))
+
+    # As get_match_history, for the games between two players; the filters are from player1's side
+    def get_match_history_between(self, player1_id, player2_id, cursor=0, count=20, colour=None, result=None, victory_status=None, opening=None):
+        return self._history_page(pair_history_key(player1_id, player2_id), history_args(player1_id, cursor, count, colour, result, victory_status, opening))
+
+    def _history_page(self, key, args):
+        return history_page(self.r.register_script(HISTORY_SCRIPT)(keys=[key], args=args))
 
     def get_player_most_used_opening(self, user_id):
-        openings = self.r.smembers(f'player:{user_id}:openings')
+        most_used = self.r.zrevrange(f'player:{user_id}:opening_counts', 0, 0)
     
         # Handle case where player has no recorded games
-        if not openings:
-            return None
-        
-        # Python 3 may need decoding
-        if isinstance(next(iter(openings)), bytes):
-            openings = [opening.decode('utf-8') for opening in openings]
-        
-        # Find the opening with the highest count
-        max_count = 0
-        most_used_opening = None
-        
-        for opening in openings:
-            # Get the count for this opening
-            count_key = f'player:{user_id}:opening:{opening}:count'
-            count = int(self.r.get(count_key) or 0)
-            
-            if count > max_count:
-                max_count = count
-                most_used_opening = opening
-        
-        return most_used_opening
+        return most_used[0] if most_used else None
+
+    # Returns the player's most played openings with their game count, wins and win rate
+    def get_player_top_openings(self, user_id, limit=5):
+        pipe = self.r.pipeline(transaction=False)
+        queue_player_top_openings(pipe, user_id, limit)
+        return player_opening_stats(pipe.execute())
+
+    # Returns the three-move sequences the player has played most, with the times played
+    def get_player_top_sequences(self, user_id, limit=10):
+        sequences = self.r.zrevrange(f'player:{user_id}:sequence_counts', 0, limit - 1, withscores=True)
+        return [{'sequence': sequence, 'count': int(count)} for sequence, count in sequences]
+
+    """
+    Builds the match history indexes from the stored games, for data loaded before they were
+    maintained at ingest. Those games get orders in scan order, after any game already
+    indexed; rerunning it leaves indexed games where they are.
+    """
+    def backfill_match_history(self, batch_size=500):
+        for game_ids in scan_game_ids(self.r, batch_size):
+            pipe = self.r.pipeline(transaction=False)
+            for game_id in game_ids:
+                pipe.hmget(f'game:{game_id}', 'white_player_id', 'black_player_id')
+            games = [(game_id, players) for game_id, players in zip(game_ids, pipe.execute()) if players[0] is not None]
+            if not games:
+                continue
+            order = self.r.incrby(ORDER_KEY, len(games)) - len(games)
+            pipe = self.r.pipeline(transaction=False)
+            for game_id, (white_player_id, black_player_id) in games:
+                order += 1
+                pipe.zadd(player_history_key(white_player_id), {game_id: order}, nx=True)
+                pipe.zadd(player_history_key(black_player_id), {game_id: order}, nx=True)
+                pipe.zadd(pair_history_key(white_player_id, black_player_id), {game_id: order}, nx=True)
+            pipe.execute()
 
 if __name__ == "__main__":
+    if sys.argv[1:] == ['backfill']:
+        PlayerFunctions().backfill_match_history()
+        sys.exit(0)
     
     user_id = input("Player functions. \n enter username: ")
     player_functions = PlayerFunctions()
 
-    choice = input("Choose an option: \n 1. View other player match history \n 2. View scheduled games \n 3. View your match history \n 4. Find player by email \n 5. Get games played with a player \n 6. Get most used opening of another player\n")
+    choice = input("Choose an option: \n 1. View other player match history \n 2. View scheduled games \n 3. View your match history \n 4. Find player by email \n 5. Get games played with a player \n 6. Get most used opening of another player \n 7. Get top openings of another player \n 8. Get top three-move sequences of another player \n 9. View your recent games\n")
     if choice == '1':
         player2_id = input("Enter other player's user_id: ")
         match_history = player_functions.view_match_history(player2_id)
@@ -68,9 +148,9 @@ if __name__ == "__main__":
         print("Match History: ", match_history)
     elif choice == '4':
         email = input("Enter email: ")
-        player_exists = player_functions.find_player_by_email(email)
-        if player_exists:
-            print("Player exists")
+        player_id = player_functions.find_player_by_email(email)
+        if player_id:
+            print("Player exists: ", player_id)
         else:
             print("Player does not exist")
     elif choice == '5':
@@ -81,5 +161,21 @@ if __name__ == "__main__":
         player2_id = input("Enter second player's user_id: ")
         most_used_opening = player_functions.get_player_most_used_opening(player2_id)
         print("Most used opening: ", most_used_opening)
+    elif choice == '7':
+        player2_id = input("Enter second player's user_id: ")
+        for opening in player_functions.get_player_top_openings(player2_id):
+            print(f"Opening: {opening['opening']}, Games: {opening['count']}, Win rate: {opening['win_rate']:.1%}")
+    elif choice == '8':
+        player2_id = input("Enter second player's user_id: ")
+        for sequence in player_functions.get_player_top_sequences(player2_id):
+            print(f"Sequence: {sequence['sequence']}, Times played: {sequence['count']}")
+    elif choice == '9':
+        colour = input("Colour (white/black, blank for any): ") or None
+        result = input("Result (win/loss/draw, blank for any): ") or None
+        opening = input("Opening ECO code (blank for any): ") or None
+        history = player_functions.get_match_history(user_id, colour=colour, result=result, opening=opening)
+        while not history['games'] and history['cursor']:
+            history = player_functions.get_match_history(user_id, cursor=history['cursor'], colour=colour, result=result, opening=opening)
+        print("Recent games: ", history['games'])
     else:
         print("Invalid choice")
@@ -0,0 +1,102 @@
+"""
+In-process read-through cache for the small, hot analytics and leaderboard reads.
+
+Every write path that changes game statistics increments the `data:version` counter in the
+same pipeline. A cache reads that counter at most once every `check_interval` seconds and
+drops all of its entries when the counter has changed, so a dashboard polling these queries
+costs about one GET per interval instead of a round trip per request. Entries also expire
+after `ttl` seconds, which bounds staleness for writes that bypass the counter.
+"""
+from collections import OrderedDict
+from config import Config
+import functools
+import threading
+import time
+
+DATA_VERSION_KEY = 'data:version'
+
+def queue_bump_version(pipe) -> None:
+    """Queue the invalidation of every query cache on `pipe`.
+    """
+    pipe.incr(DATA_VERSION_KEY)
+
+class QueryCache:
+    """Thread-safe LRU cache of query results with hit/miss statistics.
+    """
+    def __init__(self, r=None, max_entries: int = Config.QUERY_CACHE_SIZE, ttl: float = Config.QUERY_CACHE_TTL, check_interval: float = Config.QUERY_CACHE_CHECK_INTERVAL):
+        self.r = r or Config.get_redis_connection()
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.check_interval = check_interval
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.version = None
+        self.checked_at = None
+        # Bumped whenever the entries are dropped, so a load that overlapped it is not stored
+        self.generation = 0
+        self.hits = self.misses = self.evictions = self.invalidations = 0
+
+    def _check_version(self, now: float) -> None:
+        if self.checked_at is not None and now - self.checked_at < self.check_interval:
+            return
+        version = self.r.get(DATA_VERSION_KEY)
+        with self.lock:
+            if self.checked_at is not None and version != self.version:
+                self.entries.clear()
+                self.generation += 1
+                self.invalidations += 1
+            self.version, self.checked_at = version, now
+
+    def get_or_load(self, key, load):
+        """Return the cached value for `key`, calling `load()` and caching its result on a miss.
+        """
+        now = time.monotonic()
+        self._check_version(now)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > now:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            generation = self.generation
+        value = load()
+        with self.lock:
+            # The data changed while loading, so the value may predate it; return it uncached
+            if self.generation != generation:
+                return value
+            self.entries[key] = (now + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+        return value
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+            self.generation += 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            requests = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / requests if requests else 0.0,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'entries': len(self.entries)
+            }
+
+def cached(method):
+    """Serve a query method through its instance's `cache`, when it has one.
+    Results are shared between callers, so they must not be mutated.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self.cache is None:
+            return method(self, *args, **kwargs)
+        key = (type(self).__name__, method.__name__, args, tuple(sorted(kwargs.items())))
+        return self.cache.get_or_load(key, lambda: method(self, *args, **kwargs))
+    return wrapper
@@ -0,0 +1,167 @@
+"""
+Reproducible synthetic players, schedules and game records in the loader's CSV formats.
+
+The same seed and sizes always produce the same files. Games open with real ECO lines picked
+with a skewed (Zipf-like) popularity and continue with SAN moves drawn from a skewed
+vocabulary, so the sequence, opening-tree and opening indexes get the shared prefixes and
+long tails of real data. The moves look like SAN but are not legal chess beyond the book line.
+Player activity is skewed the same way, so there are prolific players and one-game players,
+as on a real server. Files are written row by row, so 10M games need little memory.
+"""
+from config import Config
+import argparse
+import bisect
+import csv
+import itertools
+import os
+import random
+
+# Opening lines by ECO code, most popular first
+OPENINGS = [
+    ('C20', ['e4', 'e5']),
+    ('B20', ['e4', 'c5']),
+    ('D00', ['d4', 'd5']),
+    ('C00', ['e4', 'e6']),
+    ('A00', ['g3']),
+    ('B01', ['e4', 'd5', 'exd5', 'Qxd5']),
+    ('C50', ['e4', 'e5', 'Nf3', 'Nc6', 'Bc4']),
+    ('A40', ['d4', 'e6']),
+    ('C41', ['e4', 'e5', 'Nf3', 'd6']),
+    ('B10', ['e4', 'c6']),
+    ('C60', ['e4', 'e5', 'Nf3', 'Nc6', 'Bb5']),
+    ('A45', ['d4', 'Nf6']),
+    ('B00', ['e4', 'Nc6']),
+    ('C42', ['e4', 'e5', 'Nf3', 'Nf6']),
+    ('D02', ['d4', 'd5', 'Nf3']),
+    ('A04', ['Nf3']),
+    ('B50', ['e4', 'c5', 'Nf3', 'd6']),
+    ('D06', ['d4', 'd5', 'c4']),
+    ('A10', ['c4']),
+    ('E00', ['d4', 'Nf6', 'c4', 'e6'])
+]
+# (winner, victory_status, weight), roughly the split of online rated games
+RESULTS = [
+    ('white', 'resign', 28), ('white', 'mate', 16), ('white', 'outoftime', 4),
+    ('black', 'resign', 26), ('black', 'mate', 15), ('black', 'outoftime', 4),
+    ('draw', 'draw', 5), ('draw', 'outoftime', 2)
+]
+PIECES = ['', 'N', 'B', 'R', 'Q', 'K']
+PIECE_WEIGHTS = list(itertools.accumulate([40, 16, 14, 12, 10, 8]))
+FILES = 'abcdefgh'
+FILE_WEIGHTS = list(itertools.accumulate([4, 6, 9, 14, 14, 9, 6, 4]))
+# Plies per game: normal around the mean, clipped to [MIN_PLIES, MAX_PLIES]
+MEAN_PLIES, PLIES_DEVIATION, MIN_PLIES, MAX_PLIES = 60, 33, 1, 350
+CHECK_RATE = 0.06
+
+def zipf_weights(n: int, exponent: float = 1.0) -> list:
+    """Cumulative weights of a Zipf distribution over n ranks, for random.choices.
+    """
+    return list(itertools.accumulate(1 / (rank ** exponent) for rank in range(1, n + 1)))
+
+def player_id(index: int) -> str:
+    return f'player{index:07d}'
+
+def game_id(index: int) -> str:
+    return f'G{index:09d}'
+
+def random_move(rnd: random.Random, white: bool) -> str:
+    """A SAN-shaped move, weighted towards central squares and pawn and minor piece moves.
+    """
+    if rnd.random() < 0.02:
+        return rnd.choice(['O-O', 'O-O', 'O-O-O'])
+    piece = rnd.choices(PIECES, cum_weights=PIECE_WEIGHTS)[0]
+    file = rnd.choices(FILES, cum_weights=FILE_WEIGHTS)[0]
+    if piece:
+        rank = rnd.randint(1, 8)
+        capture = 'x' if rnd.random() < 0.2 else ''
+        return f'{piece}{capture}{file}{rank}'
+    # Pawns only move forwards from their second rank
+    rank = rnd.randint(3, 7) if white else rnd.randint(2, 6)
+    if rnd.random() < 0.2:
+        column = FILES.index(file)
+        from_file = FILES[column + 1 if column == 0 else column - 1 if column == 7 else column + rnd.choice((-1, 1))]
+        return f'{from_file}x{file}{rank}'
+    return f'{file}{rank}'
+
+def random_moveset(rnd: random.Random, opening: list, plies: int, mate: bool) -> list:
+    moveset = list(opening[:plies])
+    while len(moveset) < plies:
+        move = random_move(rnd, len(moveset) % 2 == 0)
+        if rnd.random() < CHECK_RATE:
+            move += '+'
+        moveset.append(move)
+    if mate and moveset:
+        moveset[-1] = moveset[-1].rstrip('+') + '#'
+    return moveset
+
+def generate_players(path: str, players: int) -> None:
+    with open(path, 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(['user_id', 'email'])
+        for i in range(players):
+            writer.writerow([player_id(i), f'{player_id(i)}@example.com'])
+
+def _pick_pair(rnd: random.Random, players: int, player_weights: list) -> tuple:
+    # Spread the popularity ranks over the ids so the busiest players are not just the lowest ids
+    white, black = (bisect.bisect(player_weights, rnd.random() * player_weights[-1]) * 7919 % players for _ in range(2))
+    while black == white:
+        black = rnd.randrange(players)
+    return player_id(white), player_id(black)
+
+def generate_schedules(path: str, schedules: int, players: int, games: int, seed: int = 0, recorded: float = 0.1) -> None:
+    """Write `schedules` scheduled games; a `recorded` fraction of them reuse the id of a
+    generated game record, so loading that record removes the scheduled game.
+    """
+    rnd = random.Random(f'{seed}:schedules')
+    player_weights = zipf_weights(players, 0.8)
+    with open(path, 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(['game_id', 'player_1', 'player_2'])
+        for i in range(schedules):
+            scheduled_id = game_id(rnd.randrange(games)) if games and rnd.random() < recorded else f'S{i:09d}'
+            writer.writerow([scheduled_id, *_pick_pair(rnd, players, player_weights)])
+
+def generate_game_records(path: str, games: int, players: int, seed: int = 0) -> None:
+    rnd = random.Random(f'{seed}:games')
+    player_weights = zipf_weights(players, 0.8)
+    opening_weights = zipf_weights(len(OPENINGS))
+    result_weights = list(itertools.accumulate(weight for _, _, weight in RESULTS))
+    with open(path, 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(['game_id', 'moveset', 'winner', 'victory_status', 'number_of_turns', 'white_player_id', 'black_player_id', 'opening_eco'])
+        for i in range(games):
+            opening_eco, opening = rnd.choices(OPENINGS, cum_weights=opening_weights)[0]
+            winner, victory_status, _ = rnd.choices(RESULTS, cum_weights=result_weights)[0]
+            plies = max(MIN_PLIES, min(MAX_PLIES, int(rnd.gauss(MEAN_PLIES, PLIES_DEVIATION))))
+            moveset = random_moveset(rnd, opening, plies, victory_status == 'mate')
+            writer.writerow([game_id(i), repr(moveset), winner, victory_status, len(moveset), *_pick_pair(rnd, players, player_weights), opening_eco])
+
+def generate_dataset(directory: str, games: int, players: int = None, schedules: int = None, seed: int = 0) -> dict:
+    """Write players.csv, schedule.csv and game_records.csv to `directory`.
+    By default there is one player per 20 games and one scheduled game per 10 games.
+    Returns the paths in RedisChessLoader's argument names.
+    """
+    players = players or max(2, games // 20)
+    schedules = schedules if schedules is not None else games // 10
+    os.makedirs(directory, exist_ok=True)
+    paths = {
+        'players_path': os.path.join(directory, 'players.csv'),
+        'schedule_path': os.path.join(directory, 'schedule.csv'),
+        'game_records_path': os.path.join(directory, 'game_records.csv')
+    }
+    generate_players(paths['players_path'], players)
+    generate_schedules(paths['schedule_path'], schedules, players, games, seed)
+    generate_game_records(paths['game_records_path'], games, players, seed)
+    return paths
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Generate synthetic players, schedules and game records.')
+    parser.add_argument('--games', type=int, default=10000)
+    parser.add_argument('--players', type=int, default=None)
+    parser.add_argument('--schedules', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=os.path.join(Config.BASE_DIR, 'data', 'synthetic'))
+    args = parser.parse_args()
+    for name, path in generate_dataset(args.output, args.games, args.players, args.schedules, args.seed).items():
+        print(f"Wrote {path}")
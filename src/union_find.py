@@ -0,0 +1,93 @@
+"""
+Union-find over the player/opponent graph, persisted in Redis.
+
+`components:parent` maps each player to its parent (roots map to themselves),
+`components:size` maps each root to the size of its component and `components:sizes`
+ranks the roots by size. Both operations run as Lua scripts so every union or lookup
+is a single round trip and stays consistent when several loaders ingest at once.
+"""
+
+PARENT_KEY = 'components:parent'
+SIZE_KEY = 'components:size'
+SIZES_KEY = 'components:sizes'
+
+# Union by size with path compression; players seen for the first time become singletons.
+UNION_SCRIPT = """
+local function find(x)
+    local parent = redis.call('HGET', KEYS[1], x)
+    if not parent then
+        redis.call('HSET', KEYS[1], x, x)
+        redis.call('HSET', KEYS[2], x, 1)
+        redis.call('ZADD', KEYS[3], 1, x)
+        return x
+    end
+    local root = x
+    while parent ~= root do
+        root = parent
+        parent = redis.call('HGET', KEYS[1], root)
+    end
+    while x ~= root do
+        local parent_of_x = redis.call('HGET', KEYS[1], x)
+        redis.call('HSET', KEYS[1], x, root)
+        x = parent_of_x
+    end
+    return root
+end
+local a = find(ARGV[1])
+local b = find(ARGV[2])
+if a == b then
+    return a
+end
+local size_a = tonumber(redis.call('HGET', KEYS[2], a))
+local size_b = tonumber(redis.call('HGET', KEYS[2], b))
+if size_a < size_b then
+    a, b = b, a
+end
+redis.call('HSET', KEYS[1], b, a)
+redis.call('HSET', KEYS[2], a, size_a + size_b)
+redis.call('HDEL', KEYS[2], b)
+redis.call('ZADD', KEYS[3], size_a + size_b, a)
+redis.call('ZREM', KEYS[3], b)
+return a
+"""
+
+# Read-only root lookup for every player in ARGV; unknown players get false (None).
+FIND_SCRIPT = """
+local roots = {}
+for i, x in ipairs(ARGV) do
+    local parent = redis.call('HGET', KEYS[1], x)
+    if parent then
+        local root = x
+        while parent ~= root do
+            root = parent
+            parent = redis.call('HGET', KEYS[1], root)
+        end
+        roots[i] = root
+    else
+        roots[i] = false
+    end
+end
+return roots
+"""
+
+# Script objects by source, registered once per process with the first client that runs them.
+# Every call passes its own client, and a pipeline holding many unions checks one SHA1.
+_scripts = dict()
+
+def registered_script(client, source: str):
+    script = _scripts.get(source)
+    if script is None:
+        script = _scripts[source] = client.register_script(source)
+    return script
+
+def queue_union(pipe, player_1: str, player_2: str) -> None:
+    """Queue the union of two players' components on `pipe`.
+    """
+    registered_script(pipe, UNION_SCRIPT)(keys=[PARENT_KEY, SIZE_KEY, SIZES_KEY], args=[player_1, player_2], client=pipe)
+
+def find_roots(r, players: list) -> list:
+    """Return the component root of each player, or None for players without games.
+    """
+    if not players:
+        return []
+    return registered_script(r, FIND_SCRIPT)(keys=[PARENT_KEY], args=players, client=r)